@@ -1,12 +1,26 @@
+import pickle
 import random
 import string
 from copy import deepcopy
+from functools import partial
+from itertools import count
 from statistics import mean
 
+import numpy as np
+import pandas as pd
 import pytest
 
 import cipal
 
+WORDS = ["a b c", "d e f", "g h i", "b a", "i h g f"]
+
+
+def random_utts(seed, n):
+    # Utterances of one to six words drawn at random from WORDS
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=rng.randint(1, 6))) for i in range(n)]
+
+
 # learn --------------------------------------------------------------------------------
 
 
@@ -678,6 +692,175 @@ def test_learn_used_unused():
     assert round(ltm1["d e f"]) == round(ltm2["d e f"]) == 365
 
 
+# Test that learning with a parse cache gives the same LTM
+def test_learn_cache():
+    corpus = ["a b c d", "a b c e", "b c d", "a b"] * 50
+    ltm = cipal.new_ltm()
+    cipal.learn(corpus, ltm)
+    cache = cipal.new_cache()
+    ltm_cache = cipal.new_ltm()
+    cipal.learn(corpus, ltm_cache, cache=cache)
+    assert list(ltm_cache.items()) == list(ltm.items())
+    assert cache.stats()["hits"] > 0
+
+
+# Test that the event engine gives exactly the same LTM as the tick engine
+def test_learn_engine_event():
+    utts = random_utts(3, 300)
+    utts += ["a b c d e f g h i", "g h i d e f a b c", "d e f g h i a b c"] * 100
+    params = [
+        {},
+        {"speech_rate": 150, "decay_rate": 1000},
+        {"speech_rate": 350},
+        {"decay_rate": 1600, "pt_adjust": 20},
+        {"pt_initial": 600, "pt_ceiling": 100},
+    ]
+    for kwargs in params:
+        ltm1 = cipal.new_ltm()
+        cipal.learn(utts, ltm1, **kwargs)
+        ltm2 = cipal.new_ltm()
+        cipal.learn(utts, ltm2, engine="event", **kwargs)
+        assert list(ltm1.items()) == list(ltm2.items())
+    with pytest.raises(ValueError):
+        cipal.learn(utts, cipal.new_ltm(), engine="ticks")
+
+
+# Test that the fused engine gives exactly the same LTM as the tick engine
+def test_learn_engine_fused():
+    utts = random_utts(6, 300)
+    utts += ["a b c d e f g h i", "g h i d e f a b c", "d e f g h i a b c"] * 100
+    params = [
+        {},
+        {"speech_rate": 150, "decay_rate": 1000},
+        {"decay_rate": 4000},
+        {"pt_initial": 600, "pt_ceiling": 100},
+    ]
+    for kwargs in params:
+        ltm1 = cipal.new_ltm()
+        cipal.learn(utts, ltm1, **kwargs)
+        ltm2 = cipal.new_ltm()
+        cipal.learn(utts, ltm2, engine="fused", **kwargs)
+        assert list(ltm1.items()) == list(ltm2.items())
+
+
+# Test that callbacks see the LTM as it was after each block of utterances
+def test_learn_callbacks():
+    utts = random_utts(12, 120)
+    cdi = ["a b c", "d e f", "g h i"]
+    curve, times = [], []
+
+    def record(ltm, counters):
+        with pytest.raises(TypeError):
+            ltm["a"] = 0
+        n_vocab = cipal.vocab_size(ltm, cdi)
+        curve.append(
+            (counters["utts"], n_vocab, counters["chunks"], counters["new_chunks"])
+        )
+
+    callbacks = [
+        cipal.Callback(record, utts=50),
+        cipal.Callback(lambda ltm, counters: times.append(counters["time"]), ms=10000),
+    ]
+    ltm = cipal.new_ltm()
+    cipal.learn(utts, ltm, callbacks=callbacks)
+    expected, ltm_block = [], cipal.new_ltm()
+    for start, end in [(0, 50), (50, 100)]:
+        n_chunks = len(ltm_block)
+        cipal.learn(utts[start:end], ltm_block)
+        n_vocab = cipal.vocab_size(ltm_block, cdi)
+        expected.append((end, n_vocab, len(ltm_block), len(ltm_block) - n_chunks))
+    assert curve == expected
+    cipal.learn(utts[100:], ltm_block)
+    assert list(ltm.items()) == list(ltm_block.items())
+    # Each utterance lasts one speech_rate for each element plus the decay_rate
+    elapsed = [160 * (len(utt.split()) + 5) for utt in utts]
+    total = [sum(elapsed[: i + 1]) for i in range(len(utts))]
+    expected = [t for t, t0 in zip(total, [0] + total) if t // 10000 > t0 // 10000]
+    assert times == expected
+    with pytest.raises(ValueError):
+        cipal.Callback(record)
+
+
+# Test that a vocabulary tracker follows the CDI metrics while learning
+def test_learn_tracker():
+    utts = random_utts(13, 200)
+    cdi = ["a b c", "d e f", "g h i", "a", "j k"]
+    for engine in ("tick", "event", "fused"):
+        ltm = cipal.new_ltm()
+        tracker = cipal.new_tracker(cdi, ltm)
+        assert tracker.size() == 0 and tracker.mean_pt() == 0
+        for start, end in cipal.iter_blocks(len(utts), 50):
+            cipal.learn(utts[start:end], ltm, engine=engine, tracker=tracker)
+            assert tracker.size() == cipal.vocab_size(ltm, cdi)
+            assert tracker.mean_pt() == pytest.approx(cipal.vocab_pt(ltm, cdi))
+        temp = cipal.new_tracker(cdi, ltm)
+        assert temp.size() == tracker.size() == 4
+        assert temp.mean_pt() == pytest.approx(tracker.mean_pt())
+
+
+# learn_resumable ----------------------------------------------------------------------
+
+
+# Test that resuming after an interrupted run gives exactly the same LTM
+def test_learn_resumable(tmp_path):
+    utts = random_utts(10, 300)
+    params = {"speech_rate": 150, "engine": "fused"}
+    ltm = cipal.new_ltm()
+    fired = []
+
+    def record(ltm, counters):
+        fired.append((counters["utts"], counters["time"], counters["chunks"]))
+
+    def callbacks():
+        return [cipal.Callback(record, utts=30), cipal.Callback(record, ms=70000)]
+
+    cipal.learn(utts, ltm, callbacks=callbacks(), **params)
+    expected, fired[:] = list(fired), []
+
+    def interrupted():
+        for i, utt in enumerate(utts):
+            if i == 130:
+                raise KeyboardInterrupt
+            yield utt
+
+    path = tmp_path / "checkpoints"
+    # Only the scalar parameters are saved, not the cache or callbacks
+    state = {"cache": cipal.new_cache(), "callbacks": callbacks()}
+    with pytest.raises(KeyboardInterrupt):
+        cipal.learn_resumable(
+            interrupted(), cipal.new_ltm(), path, every=50, **params, **state
+        )
+    records = [record for end, record in cipal.read_checkpoints(path)]
+    assert [record["offset"] for record in records] == [0, 50, 100]
+    assert records[2]["params"] == params
+    assert 0 < len(records[2]["slots"]) < len(records[1]["chunks"])
+    with pytest.raises(ValueError):
+        cipal.resume(path, utts, speech_rate=100)
+    # A partly written checkpoint is dropped, and the callbacks carry on counting
+    # from the last checkpoint
+    with open(path, "ab") as f:
+        f.write(b"\xff\x00\x00\x00\x01\x02")
+    fired[:] = [counts for counts in fired if counts[0] <= 100]
+    temp = cipal.resume(path, utts, every=40, callbacks=callbacks())
+    assert list(temp.items()) == list(ltm.items())
+    assert fired == expected
+    records = [record for end, record in cipal.read_checkpoints(path)]
+    assert [record["offset"] for record in records] == [
+        0,
+        50,
+        100,
+        140,
+        180,
+        220,
+        260,
+        300,
+    ]
+    assert list(cipal.resume(path, utts).items()) == list(ltm.items())
+    (tmp_path / "empty").write_bytes(b"")
+    with pytest.raises(ValueError):
+        cipal.resume(tmp_path / "empty", utts)
+
+
 # process ------------------------------------------------------------------------------
 
 
@@ -801,6 +984,136 @@ def test_process_pt():
     assert list(temp1["parse"]) == list(temp2["parse"])
     assert all(x == 200 for x in temp1["pt"])
     assert all(x == 100 for x in temp2["pt"])
+    # Summed PTs keep the type of the PTs in LTM
+    temp = cipal.process(["a b"], {"a": 100, "b": 100, "a b": 50})
+    assert temp["pt"].dtype == np.int64
+    temp = cipal.process(["a b"], {"a": 100, "b": 1.5})
+    assert temp["pt"].dtype == np.float64
+
+
+# Test that repeated items get the same rows as when processed one at a time
+def test_process_repeated_items():
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in "abcdef"})
+    ltm.update({"a b": 50, "c d e": 20, "b c": 10})
+    items = ["a b c d e f", "f e", "a b c d e f", "", "b c", "a  b", "f e"]
+    temp = cipal.process(items, ltm)
+    assert list(temp["item"]) == items
+    assert temp["parse"][0] == "[a b] [c d e] [f]" and temp["pt"][0] == 170
+    assert temp["parse"][3] == "" and temp["chunks"][3] == 0 and temp["pt"][3] == 0
+    for i, item in enumerate(items):
+        row = cipal.process([item], ltm).iloc[0]
+        assert list(temp.iloc[i]) == list(row)
+
+
+# Test that cached parses are reused until LTM gains a chunk
+def test_process_cache():
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in "abcdef"})
+    ltm.update({"a b": 50, "c d e": 20})
+    items = ["a b c d e f", "f e", "a b c d e f", "b c"]
+    cache = cipal.new_cache(maxsize=10)
+    temp = cipal.process(items, ltm, cache)
+    assert temp.equals(cipal.process(items, ltm))
+    assert cache.stats()["misses"] == 3 and cache.stats()["hits"] == 0
+    ltm["a b"] = 10
+    temp = cipal.process(items, ltm, cache)
+    assert temp.equals(cipal.process(items, ltm)) and temp["pt"][0] == 130
+    assert cache.stats()["hits"] == 3
+    ltm["f e"] = 5
+    temp = cipal.process(items, ltm, cache)
+    assert temp.equals(cipal.process(items, ltm)) and temp["parse"][1] == "[f e]"
+    assert cache.stats()["misses"] == 6 and len(cache) == 3
+
+
+# Test that a cache shared by LTMs of the same size gives each its own parses
+def test_process_cache_ltms():
+    items = ["a b c", "c b a", "a b"]
+    ltms = [cipal.new_ltm() for i in range(3)]
+    for ltm, chunk in zip(ltms, ["a b", "b a", "c b"]):
+        ltm.update({x: 100 for x in "abc"})
+        ltm[chunk] = 50
+    cache = cipal.new_cache()
+    for i in range(2):
+        for ltm in ltms:
+            assert cipal.process(items, ltm, cache).equals(cipal.process(items, ltm))
+    assert cache.stats()["hits"] == 0
+
+
+# Test that a chunk index gives the same parses, and is not used once LTM grows
+def test_process_index():
+    utts = random_utts(15, 200)
+    ltm = cipal.new_ltm()
+    cipal.learn(utts[:100], ltm)
+    index = cipal.new_index(ltm)
+    items = utts[100:]
+    assert cipal.process(items, ltm, index=index).equals(cipal.process(items, ltm))
+    cipal.learn(utts[:20], ltm)
+    assert cipal.process(items, ltm, index=index).equals(cipal.process(items, ltm))
+    temp = pd.concat(cipal.iter_process(items, ltm, batch=30, index=index))
+    assert temp.iloc[:, :4].reset_index(drop=True).equals(cipal.process(items, ltm))
+
+
+# Test that items stream in batches with unknown elements reported per item
+def test_iter_process(tmp_path):
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in "abcdef"})
+    ltm.update({"a b": 50, "c d e": 20})
+    items = ["a b c d e f", "f x e", "b c", "y a y z", "a b c d e f", "f e"]
+    temp = list(cipal.iter_process(iter(items), ltm, batch=4))
+    assert [len(x) for x in temp] == [4, 2]
+    temp = pd.concat(temp, ignore_index=True)
+    assert list(temp["unknown"]) == ["", "x", "", "y z", "", ""]
+    known = [0, 2, 4, 5]
+    expected = cipal.process([items[i] for i in known], ltm)
+    expected["pt"] = expected["pt"].astype(np.float64)
+    assert temp.iloc[known, :4].reset_index(drop=True).equals(expected)
+    assert temp["parse"].isna().tolist() == [False, True, False, True, False, False]
+    assert temp["pt"].isna().sum() == 2 and temp["chunks"][1] == 0
+    cipal.write_process(items, ltm, tmp_path / "items.csv", batch=4)
+    temp2 = pd.read_csv(tmp_path / "items.csv", keep_default_na=False)
+    assert temp2["item"].tolist() == items and temp2["chunks"].equals(temp["chunks"])
+    assert temp2["unknown"].tolist() == temp["unknown"].tolist()
+    cipal.write_process([], ltm, tmp_path / "empty.csv")
+    assert list(pd.read_csv(tmp_path / "empty.csv").columns) == list(temp.columns)
+
+
+# Test that items can be streamed to Parquet
+def test_write_process_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in "abc"})
+    items = ["a b", "x", "c a b"] * 5
+    cipal.write_process(items, ltm, tmp_path / "items.parquet", batch=4)
+    temp = pd.read_parquet(tmp_path / "items.parquet")
+    expected = pd.concat(cipal.iter_process(items, ltm), ignore_index=True)
+    assert temp["item"].tolist() == items
+    assert temp["pt"].equals(expected["pt"])
+
+
+# Test that processing with many LTMs matches processing with each in turn
+def test_process_many():
+    utts = random_utts(9, 200)
+    ltm = cipal.new_ltm(columnar=True)
+    cipal.learn(utts[:50], ltm)
+    snapshot = ltm.snapshot()
+    cipal.learn(utts[50:], ltm)
+    ltms = {"early": snapshot, "late": ltm, "dict": dict(ltm)}
+    items = WORDS + ["a b c d e f", "b a"]
+    temp1 = cipal.process_many(items, ltms)
+    temp2 = cipal.process_many(items, ltms, workers=2)
+    assert temp1.equals(temp2)
+    assert temp1.equals(cipal.process_many(items, ltms, index=True))
+    assert temp1.equals(cipal.process_many(items, ltms, workers=2, index=True))
+    assert list(temp1.columns) == ["ltm", "item", "parse", "chunks", "pt"]
+    for ltm_id, temp in temp1.groupby("ltm", sort=False):
+        expected = cipal.process(items, ltms[ltm_id])
+        assert temp.iloc[:, 1:].reset_index(drop=True).equals(expected)
+    temp = cipal.process_many(items, [snapshot, ltm], workers=1)
+    assert list(temp["ltm"].unique()) == [0, 1]
+    with pytest.raises(ValueError, match="in 1"):
+        cipal.process_many(["a b"], [ltm, {"a": 1}])
+    assert len(cipal.process_many(items, [])) == 0
 
 
 # Test that CIPAL can parse a large list of (2000) items
@@ -848,6 +1161,171 @@ def test_process_unfamiliar():
         cipal.process(items, ltm)
 
 
+# run_replicates -----------------------------------------------------------------------
+
+
+# Test that each replicate depends on its seed but not on the number of workers
+def test_run_replicates():
+    corpus = ["a b c d", "e f g", "a b e f", "c d g", "g a b"]
+    words = ["a b", "c d", "e f g", "h i"]
+    metrics = {
+        "cdi": partial(cipal.vocab_size, words=words),
+        "pt": partial(cipal.vocab_pt, words=words),
+    }
+    kwargs = {"seeds": [3, 4, 3], "metrics": metrics, "n_utts": 120, "block": 50}
+    temp1 = cipal.run_replicates(corpus, 3, workers=1, **kwargs)
+    temp2 = cipal.run_replicates(corpus, 3, workers=2, **kwargs)
+    assert temp1.equals(temp2)
+    assert list(temp1.columns) == ["sim", "utts", "cdi", "pt"]
+    assert list(temp1["sim"]) == [0] * 4 + [1] * 4 + [2] * 4
+    assert list(temp1["utts"]) == [0, 50, 100, 120] * 3
+    assert list(temp1["cdi"][0:4]) == list(temp1["cdi"][8:12])
+    assert list(temp1["pt"][0:4]) == list(temp1["pt"][8:12])
+    assert temp1["cdi"][0] == temp1["pt"][0] == 0
+    ltm = cipal.new_ltm()
+    cipal.learn([corpus[i] for i in cipal.sample_corpus(corpus, 120, 3)], ltm)
+    assert temp1["cdi"][3] == cipal.vocab_size(ltm, words)
+    temp = cipal.run_replicates(corpus, 2, params={"engine": "fused"}, workers=1)
+    assert list(temp.columns) == ["sim", "utts", "ltm_size"]
+    with pytest.raises(ValueError):
+        cipal.run_replicates(corpus, 2, seeds=[1])
+
+
+# Test that samples depend only on the seed and that blocks cover every utterance
+def test_sample_corpus():
+    utts = ["a b", "", "c d e", "f", "g h"]
+    corpus = cipal.new_corpus(utts)
+    sample = cipal.sample_corpus(corpus, 1000, 9)
+    assert list(sample) == list(cipal.sample_corpus(utts, 1000, 9))
+    assert list(sample) != list(cipal.sample_corpus(utts, 1000, 10))
+    assert set(sample) == {0, 1, 2, 3, 4}
+    assert corpus.take(sample) == [utts[i].split() for i in sample]
+    assert corpus.take([]) == []
+    assert list(cipal.iter_blocks(120, 50)) == [(0, 50), (50, 100), (100, 120)]
+    assert list(cipal.iter_blocks(100, 50)) == [(0, 50), (50, 100)]
+    assert list(cipal.iter_blocks(0, 50)) == []
+
+
+# sweep --------------------------------------------------------------------------------
+
+
+# Test that each grid point gets one run whatever the number of workers
+def test_sweep(tmp_path):
+    corpus = ["a b c d", "e f g", "a b e f", "c d g", "g a b"] * 20
+    grid = {"speech_rate": [100, 160], "decay_rate": [800, 1600]}
+    metrics = {"ltm_size": len, "cdi": partial(cipal.vocab_size, words=["a b"])}
+    temp1 = cipal.sweep(corpus, grid, metrics, workers=1)
+    temp2 = cipal.sweep(corpus, grid, metrics, workers=2, path=tmp_path / "sweep.csv")
+    assert temp1.equals(temp2)
+    assert temp1.equals(
+        pd.read_csv(tmp_path / "sweep.csv").sort_values("run", ignore_index=True)
+    )
+    assert list(temp1.columns) == [
+        "run",
+        "speech_rate",
+        "decay_rate",
+        "ltm_size",
+        "cdi",
+    ]
+    assert list(temp1["speech_rate"]) == [100, 100, 160, 160]
+    assert list(temp1["decay_rate"]) == [800, 1600, 800, 1600]
+    ltm = cipal.new_ltm()
+    cipal.learn(corpus, ltm, speech_rate=160, decay_rate=1600)
+    assert temp1["ltm_size"][3] == len(ltm)
+    temp = cipal.sweep(corpus, [{}, {"pt_adjust": 20}], workers=1)
+    assert list(temp.columns) == ["run", "pt_adjust", "ltm_size"]
+
+
+# Test that each branch continues from the prefix as if trained from scratch
+def test_run_branches():
+    prefix = ["a b c d", "e f g", "a b e f"] * 10
+    branches = {"x": ["c d g", "g a b"] * 10, "y": ["h i", "a b h i"] * 10}
+    metrics = {"ltm_size": len, "cdi": partial(cipal.vocab_pt, words=["a b", "h i"])}
+    temp1 = cipal.run_branches(prefix, branches, metrics=metrics, workers=1)
+    temp2 = cipal.run_branches(prefix, branches, metrics=metrics, workers=2)
+    assert temp1.equals(temp2)
+    assert list(temp1.columns) == ["branch", "ltm_size", "cdi"]
+    for i, corpus in enumerate(branches.values()):
+        ltm = cipal.new_ltm()
+        cipal.learn(prefix + corpus, ltm)
+        assert temp1["ltm_size"][i] == len(ltm)
+        assert temp1["cdi"][i] == cipal.vocab_pt(ltm, ["a b", "h i"])
+    ltm = cipal.new_ltm(columnar=True)
+    temp = cipal.run_branches(prefix, list(branches.values()), ltm, workers=1)
+    assert list(temp["branch"]) == [0, 1] and temp["ltm_size"].equals(temp1["ltm_size"])
+    assert len(ltm) < temp["ltm_size"].min()
+
+
+# compile_corpus -----------------------------------------------------------------------
+
+
+# Test that a compiled corpus maps back to the utterances and is reused
+def test_compile_corpus(tmp_path, monkeypatch):
+    utts = ["[a b] c", "", "[d e f]", "a b c [d e f]", "ça va"]
+    source = tmp_path / "corpus.txt"
+    source.write_text("\n".join(utts))
+    path = cipal.compile_corpus(source, stages=[cipal.strip_brackets])
+    assert path == f"{source}.cipal"
+    corpus = cipal.load_corpus(path)
+    assert list(corpus) == [cipal.strip_brackets(utt) for utt in utts]
+    assert corpus.stream(-1) == ["ça", "va"]
+    assert not corpus.tokens.flags.writeable
+    assert list(pickle.loads(pickle.dumps(corpus))) == list(corpus)
+    # Only compile again if the source or stages change
+    monkeypatch.setattr(cipal, "new_corpus", None)
+    assert cipal.compile_corpus(source, stages=[cipal.strip_brackets]) == path
+    with pytest.raises(TypeError):
+        cipal.compile_corpus(source)
+    monkeypatch.undo()
+    source.write_text("a b")
+    assert list(cipal.load_corpus(cipal.compile_corpus(source))) == ["a b"]
+    with pytest.raises(ValueError):
+        cipal.load_corpus(source)
+    # Stages with the same name but different bodies
+    path = cipal.compile_corpus(source, stages=[lambda u: u.upper()])
+    assert list(cipal.load_corpus(path)) == ["A B"]
+    path = cipal.compile_corpus(source, stages=[lambda u: u + " z"])
+    assert list(cipal.load_corpus(path)) == ["a b z"]
+    # Builtin, partial and closure stages
+    for stage in (str.upper, str.lower):
+        path = cipal.compile_corpus(source, stages=[stage])
+        assert list(cipal.load_corpus(path)) == [stage("a b")]
+
+    def add_tag(utt, tag):
+        return f"{utt} {tag}"
+
+    def make(tag):
+        def stage(utt):
+            return f"{utt} {tag}"
+
+        return stage
+
+    for tag in ("x", "y"):
+        path = cipal.compile_corpus(source, stages=[partial(add_tag, tag=tag)])
+        assert list(cipal.load_corpus(path)) == [f"a b {tag}"]
+    for tag in ("x", "y"):
+        path = cipal.compile_corpus(source, stages=[make(tag)])
+        assert list(cipal.load_corpus(path)) == [f"a b {tag}"]
+
+
+# Test that learning from a compiled corpus gives the same LTM
+def test_compile_corpus_learn(tmp_path):
+    utts = ["a b c", "d e f", "a b c d e f", "g a b"] * 20
+    source = tmp_path / "corpus.txt"
+    source.write_text("\n".join(utts))
+    corpus = cipal.load_corpus(cipal.compile_corpus(source))
+    ltm1 = cipal.new_ltm()
+    cipal.learn(utts, ltm1)
+    ltm2 = cipal.new_ltm()
+    cipal.learn(corpus, ltm2)
+    assert list(ltm1.items()) == list(ltm2.items())
+    kwargs = {"n_utts": 100, "workers": 2}
+    temp1 = cipal.run_replicates(utts, 2, **kwargs)
+    assert temp1.equals(cipal.run_replicates(source, 2, **kwargs))
+    temp1 = cipal.sweep(utts, {"speech_rate": [100, 160]}, workers=1)
+    assert temp1.equals(cipal.sweep(corpus, {"speech_rate": [100, 160]}, workers=2))
+
+
 # new_ltm ------------------------------------------------------------------------------
 
 
@@ -861,6 +1339,121 @@ def test_new_ltm():
     assert len(ltm) == len(list(string.ascii_lowercase))
 
 
+# Test that a columnar LTM works as a mapping from chunks to PTs
+def test_new_ltm_columnar():
+    ltm = cipal.new_ltm(columnar=True)
+    assert isinstance(ltm, cipal.LTM)
+    assert ltm == {}
+    ltm.update({x: 100 for x in list(string.ascii_lowercase)})
+    assert len(ltm) == len(list(string.ascii_lowercase))
+    assert list(ltm) == list(string.ascii_lowercase)
+    assert ltm.setdefault("a", 500) == 100
+    assert ltm.setdefault("a b", 500) == 500
+    ltm["a b"] -= 50
+    assert ltm["a b"] == 450 and ltm.get("a b") == 450
+    assert "a b" in ltm and "b a" not in ltm and ltm.get("b a") is None
+    with pytest.raises(KeyError):
+        ltm["b a"]
+    with pytest.raises(TypeError):
+        del ltm["a"]
+    # Exported PTs share memory with LTM until it grows
+    pt = ltm.to_numpy()
+    assert list(pt) == list(ltm.values())
+    ltm["a"] = 50
+    assert pt[0] == 50
+    ltm["b a"] = 600
+    assert len(pt) == len(ltm) - 1 and ltm["b a"] == 600
+
+
+# Test that learning with a columnar LTM gives the same PTs as a dict
+def test_new_ltm_columnar_learn():
+    utts = random_utts(7, 300)
+    for engine in ("tick", "fused"):
+        ltm1 = cipal.new_ltm()
+        cipal.learn(utts, ltm1, engine=engine)
+        ltm2 = cipal.new_ltm(columnar=True)
+        cipal.learn(utts, ltm2, engine=engine)
+        assert list(ltm1.items()) == list(ltm2.items())
+        assert cipal.process(WORDS, ltm1).equals(cipal.process(WORDS, ltm2))
+
+
+# Test that snapshots keep the LTM as it was while learning continues
+def test_ltm_snapshot():
+    utts = random_utts(8, 300)
+    ltm = cipal.new_ltm(columnar=True)
+    cipal.learn(utts[:100], ltm)
+    expected = deepcopy(dict(ltm))
+    snapshot = ltm.snapshot()
+    cipal.learn(utts[100:], ltm)
+    assert len(ltm) > len(snapshot) and dict(ltm) != expected
+    assert dict(snapshot) == expected and 0 < len(snapshot.undo) < len(expected)
+    assert "i h g f" not in snapshot or "i h g f" in expected
+    assert cipal.process(WORDS, snapshot).equals(cipal.process(WORDS, expected))
+    assert cipal.ltm_to_df(snapshot).equals(cipal.ltm_to_df(expected))
+    assert cipal.vocab_pt(snapshot, WORDS) == cipal.vocab_pt(expected, WORDS)
+    assert len(ltm.snapshots) == 1
+    del snapshot
+    assert not ltm.snapshots
+    assert dict(pickle.loads(pickle.dumps(ltm))) == dict(ltm)
+
+
+# read_corpus --------------------------------------------------------------------------
+
+
+# Test that utterances are read lazily and passed through each stage
+def test_read_corpus(tmp_path):
+    utts = ["[a b] c", "", "[d e f]", "a b c [d e f]"]
+    path = tmp_path / "corpus.txt"
+    path.write_text("\n".join(utts) + "\n")
+    temp = cipal.read_corpus(path, cipal.strip_brackets)
+    assert list(temp) == ["a b c", "", "d e f", "a b c d e f"]
+    with open(path) as f:
+        temp = cipal.read_corpus(f, cipal.strip_brackets, str.split)
+        assert list(temp) == [["a", "b", "c"], [], ["d", "e", "f"], list("abcdef")]
+    temp = cipal.read_corpus(utts, lambda utt: utt or None)
+    assert list(temp) == ["[a b] c", "[d e f]", "a b c [d e f]"]
+    temp = cipal.read_corpus(f"a b {i}" for i in count())
+    assert next(temp) == "a b 0" and next(temp) == "a b 1"
+
+
+# Test that learning from a path or token lists gives the same LTM
+def test_read_corpus_learn(tmp_path):
+    utts = ["a b c", "d e f", "a b c d e f", "[a b c]"] * 20
+    path = tmp_path / "corpus.txt"
+    path.write_text("\n".join(utts))
+    ltm1 = cipal.new_ltm()
+    cipal.learn([cipal.strip_brackets(utt) for utt in utts], ltm1)
+    ltm2 = cipal.new_ltm()
+    cipal.learn(cipal.read_corpus(path, cipal.strip_brackets, str.split), ltm2)
+    assert list(ltm1.items()) == list(ltm2.items())
+    ltm3 = cipal.new_ltm()
+    cipal.learn(str(path), ltm3)
+    assert "[a" in ltm3 and "a" in ltm3
+
+
+# new_corpus ---------------------------------------------------------------------------
+
+
+# Test that a tokenized corpus gives back the utterances, also from shared memory
+def test_new_corpus():
+    utts = ["a b c", "", "c  b a d", "e"]
+    corpus = cipal.new_corpus(utts)
+    assert len(corpus) == 4
+    assert list(corpus) == ["a b c", "", "c b a d", "e"]
+    assert corpus[-1] == "e"
+    assert corpus.symbols == ["a", "b", "c", "d", "e"]
+    assert corpus.tokens.dtype == np.uint32
+    assert list(corpus.offsets) == [0, 3, 3, 7, 8]
+    with pytest.raises(IndexError):
+        corpus[4]
+    shm, handle = corpus.share()
+    shared = cipal.Corpus.attach(handle)
+    assert list(shared) == list(corpus)
+    del shared
+    shm.close()
+    shm.unlink()
+
+
 # new_stm ------------------------------------------------------------------------------
 
 
@@ -875,6 +1468,106 @@ def test_new_stm():
     assert stm["decay"] == []
 
 
+# STM ----------------------------------------------------------------------------------
+
+
+# Test that the STM buffers can be read like the STM hash table
+def test_stm():
+    stm = cipal.STM()
+    assert stm == cipal.new_stm()
+    assert len(stm) == 3
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in ["a", "b"]})
+    cipal.add_to_stm("a", stm, ltm, 0, 800)
+    cipal.add_to_stm("b", stm, ltm, 160, 800)
+    assert stm["chunks"] == ["a", "b"]
+    assert stm["process"] == [100, 260]
+    assert stm["decay"] == [800, 960]
+    assert cipal.check_stm(stm) is None
+    with pytest.raises(KeyError):
+        stm["time"]
+    stm.clear()
+    assert stm == {"chunks": [], "process": [], "decay": []}
+
+
+# Test that decay and compression update the STM buffers in place
+def test_stm_inplace():
+    ltm = cipal.new_ltm()
+    elements = ["a", "b", "c", "d", "e", "f"]
+    ltm.update({x: 100 for x in elements})
+    ltm.update({x: 100 for x in ["a b", "c d e"]})
+    stm1 = {
+        "chunks": elements,
+        "process": list(range(100, 700, 100)),
+        "decay": list(range(200, 800, 100)),
+    }
+    stm2 = cipal.STM()
+    for field in stm2:
+        stm2[field].extend(stm1[field])
+    recode = cipal.find_chunks(stm1["chunks"], ltm)
+    stm1 = cipal.compress_stm(recode, stm1, ltm, 50)
+    assert cipal.compress_stm(recode, stm2, ltm, 50) is stm2
+    assert stm2 == stm1
+    assert stm2["chunks"] == ["a b", "c d e", "f"]
+    stm1 = cipal.decay_stm(stm1, 300)
+    assert cipal.decay_stm(stm2, 300) is stm2
+    assert stm2 == stm1
+    assert stm2["chunks"] == ["c d e", "f"]
+
+
+# new_index ----------------------------------------------------------------------------
+
+
+# Test that a chunk index holds every chunk in LTM with two or more elements
+def test_new_index():
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in ["a", "b", "a b", "c d e"]})
+    index = cipal.new_index(ltm)
+    assert len(index) == 2
+    assert "a b" in index
+    assert "c d e" in index
+    assert "b c" not in index
+    assert "c d" not in index
+    assert "a" not in index
+    index.add("a b")
+    assert len(index) == 2
+
+
+# Test that an index is only used with the LTM and size it was built for
+def test_new_index_ltm():
+    ltm = {"a": 1, "b": 1}
+    index = cipal.new_index(ltm)
+    ltm["a b"] = 1
+    assert not index.matches(ltm)
+    assert cipal.find_chunks(["a", "b"], ltm, index) == [1, 1]
+    index.update(ltm)
+    assert index.matches(ltm) and "a b" in index
+    assert cipal.find_chunks(["a", "b"], ltm, index) == [1, 1]
+    other = dict(ltm)
+    assert not index.matches(other)
+    with pytest.raises(ValueError):
+        index.update(other)
+    ltm = cipal.new_ltm(columnar=True)
+    ltm.update({"a": 1, "b": 1, "a b": 1})
+    snapshot = ltm.snapshot()
+    index = cipal.new_index(snapshot)
+    assert index.matches(ltm) and index.matches(snapshot)
+    ltm["b a"] = 1
+    assert index.matches(snapshot) and not index.matches(ltm)
+
+
+# Test that the chunk index interns each element as a small int
+def test_new_index_symbols():
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in ["w", "0", "z", "w 0", "w 0 z", "z w"]})
+    index = cipal.new_index(ltm)
+    assert index.symbols == {"w": 0, "0": 1, "z": 2}
+    assert index.encode(["w 0 z", "q", "z"]) == [[0, 1, 2], [-1], [2]]
+    # One edge for each trie node: w, w 0, w 0 z, z and z w
+    assert len(index.edges) == 5
+    assert all(isinstance(key, int) for key in index.edges)
+
+
 # check_stm ----------------------------------------------------------------------------
 
 
@@ -1382,6 +2075,94 @@ def test_find_compress_abcdef():
     assert len(stm["chunks"]) == len(stm["process"]) == len(stm["decay"]) == 1
 
 
+# Test that the chunk index recodes STM in the same way as LTM
+def test_find_chunks_index():
+    rng = random.Random(2)
+    letters = list(string.ascii_lowercase)[0:6]
+    for i in range(200):
+        ltm = cipal.new_ltm()
+        ltm.update({x: 100 for x in letters})
+        for j in range(rng.randint(0, 30)):
+            ltm[" ".join(rng.choices(letters, k=rng.randint(2, 5)))] = 100
+        chunks = list(ltm)
+        stm_chunks = rng.choices(chunks, k=rng.randint(0, 8))
+        index = cipal.new_index(ltm)
+        recode = cipal.find_chunks(stm_chunks, ltm)
+        assert cipal.find_chunks(stm_chunks, ltm, index) == recode
+
+
+# Test that only the sequences ending with a new chunk are checked after a parse
+def test_find_chunks_parsed():
+    rng = random.Random(4)
+    letters = list(string.ascii_lowercase)[0:6]
+    for i in range(200):
+        ltm = cipal.new_ltm()
+        ltm.update({x: 100 for x in letters})
+        for j in range(rng.randint(0, 30)):
+            ltm[" ".join(rng.choices(letters, k=rng.randint(2, 5)))] = 100
+        index = cipal.new_index(ltm)
+        n_chunks = rng.randint(1, 8)
+        stm = {
+            "chunks": rng.choices(letters, k=n_chunks),
+            "process": [0] * n_chunks,
+            "decay": [0] * n_chunks,
+        }
+        recode = cipal.find_chunks(stm["chunks"], ltm, index)
+        stm = cipal.compress_stm(recode, stm, ltm, 0)
+        parsed = len(stm["chunks"])
+        for temp in (index, None):
+            recode = cipal.find_chunks(stm["chunks"], ltm, temp, parsed)
+            assert recode == cipal.find_chunks(stm["chunks"], ltm)
+            assert recode == list(range(parsed, 0, -1))
+            stm_chunks = stm["chunks"] + [rng.choice(letters)]
+            recode = cipal.find_chunks(stm_chunks, ltm, temp, parsed)
+            assert recode == cipal.find_chunks(stm_chunks, ltm)
+
+
+# Test that cached recodes match uncached ones and are dropped when LTM grows
+def test_find_chunks_cache():
+    rng = random.Random(5)
+    letters = list(string.ascii_lowercase)[0:4]
+    ltm = cipal.new_ltm()
+    ltm.update({x: 100 for x in letters})
+    index = cipal.new_index(ltm)
+    cache = cipal.new_cache(maxsize=20)
+    for i in range(300):
+        if rng.random() < 0.1:
+            chunk = " ".join(rng.choices(letters, k=rng.randint(2, 3)))
+            ltm.setdefault(chunk, 100)
+            index.update(ltm)
+        stm_chunks = rng.choices(letters, k=rng.randint(1, 5))
+        expected = cipal.find_chunks(stm_chunks, ltm)
+        assert cipal.find_chunks(stm_chunks, ltm, None, 0, cache) == expected
+        assert cipal.find_chunks(stm_chunks, ltm, index, 0, cache) == expected
+        assert len(cache) <= 20
+    stats = cache.stats()
+    assert stats["hits"] > 0
+    assert stats["hits"] + stats["misses"] == 600
+    assert stats["hit_rate"] == stats["hits"] / 600
+
+
+# Test that a cache used with another LTM of the same size is cleared first
+def test_find_chunks_cache_ltm():
+    ltm1 = {"a": 1, "b": 1, "a b": 1}
+    ltm2 = {"a": 1, "b": 1, "b a": 1}
+    cache = cipal.new_cache()
+    assert cipal.find_chunks(["a", "b"], ltm1, cache=cache) == [1, 1]
+    assert cipal.find_chunks(["a", "b"], ltm2, cache=cache) == [2, 1]
+    assert cipal.find_chunks(["a", "b"], ltm1, cache=cache) == [1, 1]
+    assert cache.stats()["hits"] == 0
+    ltm = cipal.new_ltm(columnar=True)
+    ltm.update(ltm1)
+    snapshot = ltm.snapshot()
+    assert cipal.find_chunks(["a", "b"], snapshot, cache=cache) == [1, 1]
+    assert cipal.find_chunks(["a", "b"], ltm, cache=cache) == [1, 1]
+    assert cache.stats()["hits"] == 1
+    ltm["b a"] = 1
+    assert cipal.find_chunks(["b", "a"], snapshot, cache=cache) == [2, 1]
+    assert cipal.find_chunks(["b", "a"], ltm, cache=cache) == [1, 1]
+
+
 # decay_stm ----------------------------------------------------------------------------
 
 
@@ -1534,6 +2315,49 @@ def test_adjust_pt_ceiling():
     assert all(x == 1000 for x in temp["pt"])
 
 
+# Test that adjusting over many ticks at once gives exactly the same PTs
+def test_adjust_pt_ticks():
+    rng = random.Random(14)
+    elements = list(string.ascii_lowercase)[0:6]
+    for pt_adjust, pt_ceiling in [(5.0, 10.0), (-50, 590), (0, 10)]:
+        ltm1 = {x: rng.uniform(300, 1200) for x in elements}
+        ltm2 = dict(ltm1)
+        tracker1 = cipal.new_tracker(elements[:3], ltm1)
+        tracker2 = cipal.new_tracker(elements[:3], ltm2)
+        stm = {"chunks": rng.choices(elements, k=5), "process": [], "decay": []}
+        for i in range(40):
+            cipal.adjust_pt(ltm1, stm, pt_adjust, 1200, pt_ceiling, tracker1)
+        cipal.adjust_pt_ticks(ltm2, stm, 40, pt_adjust, 1200, pt_ceiling, tracker2)
+        assert ltm2 == ltm1
+        assert tracker2.total == pytest.approx(tracker1.total)
+
+
+# Test that the batched update matches adjust_pt, including repeated chunks
+def test_adjust_pt_batch():
+    rng = random.Random(8)
+    elements = list(string.ascii_lowercase)[0:8]
+    for pt_adjust, pt_ceiling in [(5.0, 10.0), (-50, 590), (20, 300)]:
+        ltm1 = cipal.new_ltm()
+        ltm1.update({x: rng.uniform(300, 1200) for x in elements})
+        ltm2 = cipal.new_ltm(columnar=True)
+        ltm2.update(ltm1)
+        pt = ltm2.to_numpy(writeable=True)
+        for i in range(50):
+            chunks = rng.choices(elements, k=rng.randint(0, 6))
+            stm = {"chunks": chunks, "process": [0] * 6, "decay": [0] * 6}
+            cipal.adjust_pt(ltm1, stm, pt_adjust, 1200, pt_ceiling)
+            slots = [ltm2.slots[chunk] for chunk in chunks]
+            cipal.adjust_pt_batch(pt, slots, pt_adjust, 1200, pt_ceiling)
+        assert list(ltm2.values()) == pytest.approx(list(ltm1.values()))
+        assert min(ltm2.values()) >= pt_ceiling
+    pt = np.array([600.0, 600.0])
+    cipal.adjust_pt_batch(pt, [0], 10, 1200, 10)
+    assert round(pt[0]) == 594 and pt[1] == 600
+    assert cipal.pt_sigmoid_batch(np.array([600.0]), 600)[0] == cipal.pt_sigmoid(
+        600, 600
+    )
+
+
 # ltm_to_df ----------------------------------------------------------------------------
 
 
@@ -1552,3 +2376,77 @@ def test_ltm_to_df():
     assert len(pt) == 1 and pt[0] == 459
     assert all(temp["chunks"] == ["a", "b", "c"])
     assert all(temp["pt"] == [100, 207, 459])
+
+
+# Test that a columnar LTM gives the same data frame and can share its PTs
+def test_ltm_to_df_columnar():
+    ltm = cipal.new_ltm(columnar=True)
+    ltm.update({"a": 100, "b": 207, "c": 459})
+    temp = cipal.ltm_to_df(ltm)
+    assert temp.equals(cipal.ltm_to_df(dict(ltm)))
+    ltm["a"] = 50
+    assert temp["pt"][0] == 100
+    temp = cipal.ltm_to_df(ltm, copy=False)
+    assert np.shares_memory(temp["pt"].to_numpy(), ltm.to_numpy())
+
+
+# Test that chunk lengths are counted in elements
+def test_ltm_to_df_lengths():
+    ltm = {"a": 100.0, "a b": 50.0, "c d e": 20.0}
+    temp = cipal.ltm_to_df(ltm, lengths=True)
+    assert list(temp.columns) == ["chunks", "pt", "length"]
+    assert list(temp["length"]) == [1, 2, 3]
+    ltm2 = cipal.new_ltm(columnar=True)
+    ltm2.update(ltm)
+    assert temp.equals(cipal.ltm_to_df(ltm2, lengths=True))
+    assert cipal.ltm_to_df(ltm).equals(temp[["chunks", "pt"]])
+
+
+# Test that LTM can be exported to Parquet and Feather
+def test_export_ltm(tmp_path):
+    pytest.importorskip("pyarrow")
+    ltm = cipal.new_ltm(columnar=True)
+    ltm.update({"a": 100.0, "a b": 50.0, "c d e": 20.0})
+    expected = cipal.ltm_to_df(ltm, lengths=True)
+    cipal.export_ltm(ltm, tmp_path / "ltm.parquet", lengths=True)
+    temp = pd.read_parquet(tmp_path / "ltm.parquet")
+    assert temp["chunks"].tolist() == expected["chunks"].tolist()
+    assert temp["pt"].equals(expected["pt"]) and temp["length"].equals(
+        expected["length"]
+    )
+    cipal.export_ltm(dict(ltm), tmp_path / "ltm.feather")
+    temp = pd.read_feather(tmp_path / "ltm.feather")
+    assert temp["chunks"].tolist() == expected["chunks"].tolist()
+    assert temp["pt"].equals(expected["pt"])
+    with pytest.raises(ValueError):
+        cipal.export_ltm(ltm, tmp_path / "ltm.csv")
+
+
+# save_ltm -----------------------------------------------------------------------------
+
+
+# Test that a saved LTM loads back with the same chunks, PTs and order
+def test_save_ltm(tmp_path):
+    rng = random.Random(11)
+    words = ["w 0 z", "w 0 z e", "ça va", "a b c", "b a", "w 0"]
+    utts = [" ".join(rng.choices(words, k=rng.randint(1, 5))) for i in range(200)]
+    ltm = cipal.new_ltm()
+    cipal.learn(utts, ltm)
+    for restart in (1, 3, 16):
+        cipal.save_ltm(ltm, tmp_path / "ltm", restart)
+        assert list(cipal.load_ltm(tmp_path / "ltm").items()) == list(ltm.items())
+        temp = cipal.load_ltm(tmp_path / "ltm", columnar=True)
+        assert isinstance(temp, cipal.LTM)
+        assert list(temp.items()) == list(ltm.items())
+        ltm_file = cipal.open_ltm(tmp_path / "ltm")
+        assert len(ltm_file) == len(ltm)
+        assert list(ltm_file) == sorted(ltm)
+        assert all(ltm_file[chunk] == pt for chunk, pt in ltm.items())
+        for chunk in ["", "a b c w", "zz", "w 0 z w", "ç"]:
+            assert chunk not in ltm_file and ltm_file.get(chunk) is None
+    cipal.save_ltm({}, tmp_path / "empty")
+    assert cipal.load_ltm(tmp_path / "empty") == {}
+    assert "a" not in cipal.open_ltm(tmp_path / "empty")
+    (tmp_path / "corpus.txt").write_text("a b c")
+    with pytest.raises(ValueError):
+        cipal.open_ltm(tmp_path / "corpus.txt")
@@ -5,8 +5,30 @@ Authors: Andrew Jessop, Julian Pine, and Fernand Gobet
 
 """
 
-from math import exp
+import csv
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+from hashlib import sha256
+from inspect import signature
+from itertools import islice, product, repeat
+from math import ceil, exp
+from mmap import ACCESS_READ, mmap
+from multiprocessing import get_all_start_methods, get_context
+from multiprocessing.shared_memory import SharedMemory
+from os import PathLike, fspath, fsync, replace
+from statistics import mean
+from types import CodeType, MappingProxyType
+from weakref import ref
+from zlib import crc32
 
+import numpy as np
 import pandas as pd
 
 
@@ -18,65 +40,1196 @@ def learn(
     pt_adjust=5.0,
     pt_initial=1200.0,
     pt_ceiling=10.0,
+    engine="tick",
+    cache=None,
+    callbacks=(),
+    tracker=None,
 ):
+    if engine not in ("tick", "event", "fused"):
+        raise ValueError(f"Unknown engine: {engine}")
+    if isinstance(corpus, (str, PathLike)):
+        corpus = read_corpus(corpus)
+    elif isinstance(corpus, Corpus):
+        corpus = corpus.streams()
+    if callbacks:
+        for callback in callbacks:
+            callback.start(len(ltm))
+        corpus = run_callbacks(corpus, callbacks, ltm, speech_rate, decay_rate)
+    stm = STM()
     for utt in corpus:
-        stream = utt.split()
+        stream = utt.split() if isinstance(utt, str) else list(utt)
         speech_times = list(
             range(0, (len(stream) * speech_rate) + decay_rate, speech_rate)
         )
-        stm = new_stm()
+        stm.clear()
+        if engine == "event":
+            learn_events(
+                stream,
+                len(speech_times),
+                ltm,
+                stm,
+                speech_rate,
+                decay_rate,
+                pt_adjust,
+                pt_initial,
+                pt_ceiling,
+                tracker,
+            )
+            continue
         for i, t in enumerate(speech_times):
             if i < len(stream):
-                learn_element(stream[i], ltm, pt_initial)
+                learn_element(stream[i], ltm, pt_initial, tracker)
                 add_to_stm(stream[i], stm, ltm, t, decay_rate)
             if len(stm["chunks"]) > 1:
-                learn_chunks(ltm, stm, t)
-                recode = find_chunks(stm["chunks"], ltm)
-                stm = compress_stm(recode, stm, ltm, t)
+                if engine == "fused":
+                    learn_step(ltm, stm, t, tracker)
+                else:
+                    learn_chunks(ltm, stm, t, tracker)
+                    recode = find_chunks(
+                        stm["chunks"], ltm, parsed=stm.parsed_chunks(ltm), cache=cache
+                    )
+                    stm = compress_stm(recode, stm, ltm, t)
+                    stm.mark_parsed(ltm)
             stm = decay_stm(stm, t)
-            adjust_pt(ltm, stm, pt_adjust, pt_initial, pt_ceiling)
+            adjust_pt(ltm, stm, pt_adjust, pt_initial, pt_ceiling, tracker)
 
 
-def process(items, ltm):
+class Callback:
+    # Calls fn(ltm, counters) from learn every n utterances and/or every n ms of
+    # simulated time, with a read-only view of LTM
+    def __init__(self, fn, utts=None, ms=None):
+        if utts is None and ms is None:
+            raise ValueError("Callback needs utts or ms")
+        self.fn = fn
+        self.utts = utts
+        self.ms = ms
+        self.next_utts = self.next_ms = self.n_chunks = None
+
+    def start(self, n_chunks, n_utts=0, time_t=0):
+        # Thresholds follow on from n_utts and time_t when a run is carried on
+        if self.utts is not None:
+            self.next_utts = (n_utts // self.utts + 1) * self.utts
+        if self.ms is not None:
+            self.next_ms = (time_t // self.ms + 1) * self.ms
+        self.n_chunks = n_chunks
+
+    def update(self, ltm, n_utts, time_t):
+        due = False
+        if self.utts is not None and n_utts >= self.next_utts:
+            self.next_utts = (n_utts // self.utts + 1) * self.utts
+            due = True
+        if self.ms is not None and time_t >= self.next_ms:
+            self.next_ms = (time_t // self.ms + 1) * self.ms
+            due = True
+        if due:
+            counters = {
+                "utts": n_utts,
+                "time": time_t,
+                "chunks": len(ltm),
+                "new_chunks": len(ltm) - self.n_chunks,
+            }
+            self.n_chunks = len(ltm)
+            self.fn(ltm, counters)
+
+
+def run_callbacks(corpus, callbacks, ltm, speech_rate, decay_rate, n_utts=0, time_t=0):
+    # Pass the utterances on to learn, which asks for the next one once it has
+    # learned the last, and call the callbacks that are then due. n_utts and time_t
+    # carry the counts on from earlier blocks of the same run.
+    view = MappingProxyType(ltm)
+    for utt in corpus:
+        yield utt
+        n_utts += 1
+        time_t += utt_time(utt, speech_rate, decay_rate)
+        for callback in callbacks:
+            callback.update(view, n_utts, time_t)
+
+
+def utt_time(utt, speech_rate, decay_rate):
+    # Simulated time that learn spends on an utterance
+    n_elements = len(utt.split()) if isinstance(utt, str) else len(utt)
+    n_ticks = len(range(0, (n_elements * speech_rate) + decay_rate, speech_rate))
+    return n_ticks * speech_rate
+
+
+def learn_events(
+    stream,
+    n_ticks,
+    ltm,
+    stm,
+    speech_rate,
+    decay_rate,
+    pt_adjust,
+    pt_initial,
+    pt_ceiling,
+    tracker=None,
+):
+    i = 0
+    while i < n_ticks:
+        t = i * speech_rate
+        if i < len(stream):
+            learn_element(stream[i], ltm, pt_initial, tracker)
+            add_to_stm(stream[i], stm, ltm, t, decay_rate)
+        n_ltm, n_stm = len(ltm), len(stm["chunks"])
+        if n_stm > 1:
+            learn_step(ltm, stm, t, tracker)
+        decay_stm(stm, t)
+        adjust_pt(ltm, stm, pt_adjust, pt_initial, pt_ceiling, tracker)
+        i += 1
+        # After a tick that changed nothing, STM and LTM stay the same until the next
+        # element arrives, a chunk is processed, or a chunk decays. Only the PT
+        # adjustments are needed for the ticks in between.
+        if i >= len(stream) and len(ltm) == n_ltm and len(stm["chunks"]) == n_stm:
+            times = [time_t for time_t in stm["process"] if time_t > t]
+            times.extend(stm["decay"])
+            next_i = (
+                min(first_tick(min(times), speech_rate), n_ticks) if times else n_ticks
+            )
+            if next_i > i:
+                adjust_pt_ticks(
+                    ltm, stm, next_i - i, pt_adjust, pt_initial, pt_ceiling, tracker
+                )
+                i = next_i
+
+
+def first_tick(time_t, speech_rate):
+    # Index of the first tick at or after time_t
+    i = max(0, ceil(time_t / speech_rate))
+    while i > 0 and (i - 1) * speech_rate >= time_t:
+        i -= 1
+    while i * speech_rate < time_t:
+        i += 1
+    return i
+
+
+CHECKPOINT_FRAME = struct.Struct("<II")  # Checkpoint length and CRC32
+# learn parameters saved in checkpoints. The others (cache, callbacks and tracker) hold
+# state, so they are passed to resume again rather than copied into every record.
+CHECKPOINT_PARAMS = (
+    "speech_rate",
+    "decay_rate",
+    "pt_adjust",
+    "pt_initial",
+    "pt_ceiling",
+    "engine",
+)
+
+
+def learn_resumable(corpus, ltm, path, every=10000, offset=0, time_t=0, **params):
+    # learn in blocks of utterances, appending a checkpoint to path after each block.
+    # The first checkpoint holds the whole LTM and later ones only the chunks added
+    # and the PTs changed since, with the corpus offset, simulated time and learn
+    # parameters.
+    saved = {key: value for key, value in params.items() if key in CHECKPOINT_PARAMS}
+    # Callbacks are started once and run here, so their counts span the whole run
+    # rather than restarting with each block
+    callbacks = params.pop("callbacks", ())
+    defaults = signature(learn).parameters
+    speech_rate = params.get("speech_rate", defaults["speech_rate"].default)
+    decay_rate = params.get("decay_rate", defaults["decay_rate"].default)
+    for callback in callbacks:
+        callback.start(len(ltm), offset, time_t)
+    if isinstance(corpus, (str, PathLike)):
+        corpus = read_corpus(corpus)
+    elif isinstance(corpus, Corpus):
+        corpus = corpus.streams()
+    utts = iter(corpus)
+    pt = np.empty(0)
+    if offset:
+        pt = np.fromiter(ltm.values(), np.float64, len(ltm))
+    with open(path, "ab" if offset else "wb") as f:
+        if not offset:
+            pt = write_checkpoint(f, ltm, pt, offset, time_t, every, saved)
+        while True:
+            block = list(islice(utts, every))
+            if not block:
+                break
+            stream = block
+            if callbacks:
+                stream = run_callbacks(
+                    block, callbacks, ltm, speech_rate, decay_rate, offset, time_t
+                )
+            learn(stream, ltm, **params)
+            offset += len(block)
+            time_t += sum(utt_time(utt, speech_rate, decay_rate) for utt in block)
+            pt = write_checkpoint(f, ltm, pt, offset, time_t, every, saved)
+    return ltm
+
+
+def write_checkpoint(f, ltm, pt, offset, time_t, every, params):
+    # Chunks are never removed from LTM, so new chunks are the ones after the PTs
+    # in the last checkpoint
+    n_chunks = len(pt)
+    pt_new = np.fromiter(ltm.values(), np.float64, len(ltm))
+    slots = np.flatnonzero(pt_new[:n_chunks] != pt)
+    record = {
+        "offset": offset,
+        "time": time_t,
+        "every": every,
+        "params": params,
+        "chunks": list(islice(ltm, n_chunks, None)),
+        "chunks_pt": pt_new[n_chunks:],
+        "slots": slots,
+        "pt": pt_new[slots],
+    }
+    payload = pickle.dumps(record)
+    f.write(CHECKPOINT_FRAME.pack(len(payload), crc32(payload)) + payload)
+    f.flush()
+    fsync(f.fileno())
+    return pt_new
+
+
+def read_checkpoints(path):
+    # Yield each complete checkpoint with its end position in the file, stopping at
+    # the first one that was only partly written
+    with open(path, "rb") as f:
+        while True:
+            frame = f.read(CHECKPOINT_FRAME.size)
+            if len(frame) < CHECKPOINT_FRAME.size:
+                return
+            length, crc = CHECKPOINT_FRAME.unpack(frame)
+            payload = f.read(length)
+            if len(payload) < length or crc32(payload) != crc:
+                return
+            yield f.tell(), pickle.loads(payload)
+
+
+def resume(path, corpus, every=None, **state):
+    # Rebuild the LTM from the checkpoints in path and carry on learning the corpus
+    # from the last offset, with the same parameters plus any cache, callbacks or
+    # tracker given again. every can be changed for the rest of the run.
+    fixed = [key for key in state if key in CHECKPOINT_PARAMS]
+    if fixed:
+        raise ValueError(f"Parameters are read from the checkpoints: {fixed}")
+    chunks, pt, end, record = [], np.empty(0), 0, None
+    for end, record in read_checkpoints(path):
+        chunks.extend(record["chunks"])
+        pt = np.concatenate([pt, record["chunks_pt"]])
+        pt[record["slots"]] = record["pt"]
+    if record is None:
+        raise ValueError(f"No checkpoints in {path}")
+    with open(path, "r+b") as f:
+        f.truncate(end)  # Drop a partly written checkpoint
+    ltm = dict(zip(chunks, pt.tolist()))
+    if isinstance(corpus, (str, PathLike)):
+        corpus = read_corpus(corpus)
+    elif isinstance(corpus, Corpus):
+        corpus = corpus.streams()
+    utts = islice(corpus, record["offset"], None)
+    every = record["every"] if every is None else every
+    return learn_resumable(
+        utts,
+        ltm,
+        path,
+        every,
+        record["offset"],
+        record["time"],
+        **record["params"],
+        **state,
+    )
+
+
+def process(items, ltm, cache=None, index=None):
+    # Tokenize each distinct item once
+    streams = {item: item.split() for item in items}
     # Raise an error if the items contain any unknown elements
-    elements = set(element for item in items for element in item.split())
+    elements = set(element for stream in streams.values() for element in stream)
     unknown = [element for element in elements if element not in ltm]
     if unknown:
         raise ValueError(f"Items contain unknown elements: {unknown}")
-    # Recode each item using the chunks stored in LTM
+    return process_streams(items, streams, ltm, cache, index)
+
+
+def process_streams(items, streams, ltm, cache=None, index=None):
+    # Recode each distinct item using the chunks stored in LTM. A cache keeps the
+    # recodes across calls until LTM gains a chunk or another LTM is processed, but
+    # the PTs are always read anew. A chunk index from new_index(ltm) speeds up long
+    # items. Items without a stream are left unparsed.
     parse_list, chunk_list, pt_list = [], [], []
-    for item in items:
-        stream = item.split()
-        recode = find_chunks(stream, ltm)
-        unique_indices = list(dict.fromkeys(recode))
-        parse, pt = [], []
-        for index in unique_indices:
-            chunk_indices = [j for j, idx in enumerate(recode) if idx == index]
-            chunk = " ".join([stream[j] for j in chunk_indices])
-            parse.append(f"[{chunk}]")
-            pt.append(ltm[chunk])
-        parse_list.append(" ".join(parse))
-        chunk_list.append(len(parse))
-        pt_list.append(sum(pt))
+    for stream in streams.values():
+        if stream is None:
+            parse_list.append(None)
+            chunk_list.append(0)
+            pt_list.append(np.nan)
+            continue
+        chunks = recode_chunks(stream, find_chunks(stream, ltm, index, cache=cache))
+        parse_list.append(" ".join([f"[{chunk}]" for chunk in chunks]))
+        chunk_list.append(len(chunks))
+        pt_list.append(sum([ltm[chunk] for chunk in chunks]))
+    # Gather the row of each item from the distinct items
+    rows = dict(zip(streams, range(len(streams))))
+    rows = np.fromiter(map(rows.__getitem__, items), np.intp, len(items))
+    parse = np.empty(len(parse_list), dtype=object)
+    parse[:] = parse_list
     return pd.DataFrame(
-        {"item": items, "parse": parse_list, "chunks": chunk_list, "pt": pt_list}
+        {
+            "item": items,
+            "parse": parse[rows],
+            "chunks": np.array(chunk_list, dtype=np.int64)[rows],
+            # Left to numpy, so PTs that are all ints stay int64
+            "pt": np.array(pt_list)[rows],
+        }
+    )
+
+
+def iter_process(items, ltm, batch=10000, cache=None, index=None):
+    # Process any iterable of items in tables of up to batch rows. Rather than
+    # raising, items with unknown elements are left unparsed (with a missing PT) and
+    # their unknown elements are listed in an extra column.
+    items = iter(items)
+    while batch_items := list(islice(items, batch)):
+        streams, unknown = {}, {}
+        for item in batch_items:
+            if item not in streams:
+                stream = item.split()
+                missing = [element for element in stream if element not in ltm]
+                streams[item] = None if missing else stream
+                unknown[item] = " ".join(dict.fromkeys(missing))
+        temp = process_streams(batch_items, streams, ltm, cache, index)
+        # Unparsed items have a missing PT, so every batch has float PTs
+        temp["pt"] = temp["pt"].astype(np.float64)
+        temp["unknown"] = [unknown[item] for item in batch_items]
+        yield temp
+
+
+def write_process(items, ltm, path, batch=10000, cache=None, index=None):
+    # Stream the processed items to a CSV file, or to Parquet or Feather by the path
+    # suffix (which needs pyarrow), holding one batch in memory at a time
+    path = fspath(path)
+    if path.endswith((".parquet", ".feather", ".arrow")):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [
+                ("item", pa.string()),
+                ("parse", pa.string()),
+                ("chunks", pa.int64()),
+                ("pt", pa.float64()),
+                ("unknown", pa.string()),
+            ]
+        )
+        if path.endswith(".parquet"):
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        with writer:
+            for temp in iter_process(items, ltm, batch, cache, index):
+                writer.write_table(
+                    pa.Table.from_pandas(temp, schema, preserve_index=False)
+                )
+        return
+    with open(path, "w", newline="") as f:
+        header = True
+        for temp in iter_process(items, ltm, batch, cache, index):
+            temp.to_csv(f, header=header, index=False)
+            header = False
+        if header:
+            f.write(",".join(["item", "parse", "chunks", "pt", "unknown"]) + "\n")
+
+
+def process_many(items, ltms, workers=1, index=False):
+    # Process the same items with each LTM (a dict of LTMs or snapshots by id, or a
+    # list), returning one long table with the LTM id in the first column. The items
+    # are tokenized and their distinct elements collected once for all the LTMs. With
+    # index set, a chunk index is built for each LTM, which pays off for long items.
+    if not isinstance(ltms, dict):
+        ltms = dict(enumerate(ltms))
+    streams = {item: item.split() for item in items}
+    elements = list(set(element for stream in streams.values() for element in stream))
+    for ltm_id, ltm in ltms.items():
+        unknown = [element for element in elements if element not in ltm]
+        if unknown:
+            raise ValueError(f"Items contain unknown elements in {ltm_id}: {unknown}")
+    if workers == 1:
+        tables = [
+            process_streams(
+                items, streams, ltm, index=new_index(ltm) if index else None
+            )
+            for ltm in ltms.values()
+        ]
+    else:
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=fork_context(),
+            initializer=attach_items,
+            initargs=(items, streams, ltms, index),
+        ) as pool:
+            tables = list(pool.map(process_worker, ltms))
+    for ltm_id, temp in zip(ltms, tables):
+        temp.insert(0, "ltm", [ltm_id] * len(temp))
+    if not tables:
+        return pd.DataFrame(columns=["ltm", "item", "parse", "chunks", "pt"])
+    return pd.concat(tables, ignore_index=True)
+
+
+worker_items = None  # Items, streams and LTMs attached by each process_many worker
+
+
+def attach_items(items, streams, ltms, index=False):
+    global worker_items
+    worker_items = items, streams, ltms, index
+
+
+def process_worker(ltm_id):
+    items, streams, ltms, index = worker_items
+    ltm = ltms[ltm_id]
+    return process_streams(items, streams, ltm, index=new_index(ltm) if index else None)
+
+
+def recode_chunks(stream, recode):
+    # Each chunk of a recode is a run of elements with the same chunk id
+    chunks, start_index = [], 0
+    for end_index in range(1, len(recode)):
+        if recode[end_index] != recode[end_index - 1]:
+            chunks.append(" ".join(stream[start_index:end_index]))
+            start_index = end_index
+    if stream:
+        chunks.append(" ".join(stream[start_index:]))
+    return chunks
+
+
+def run_replicates(
+    corpus,
+    n,
+    seeds=None,
+    params=None,
+    metrics=None,
+    n_utts=10000,
+    block=50,
+    workers=None,
+):
+    # Train n models on random samples of the corpus, scoring each one after every
+    # block of utterances. The sample depends only on the seed, not on the worker.
+    if isinstance(corpus, (str, PathLike)):
+        corpus = load_corpus(compile_corpus(corpus))
+    elif not isinstance(corpus, Corpus):
+        corpus = list(corpus)
+    seeds = list(range(n)) if seeds is None else list(seeds)
+    if len(seeds) != n:
+        raise ValueError(f"Expected {n} seeds but got {len(seeds)}")
+    params = {} if params is None else params
+    metrics = {"ltm_size": len} if metrics is None else metrics
+    args = [corpus] * n, seeds, [params] * n, [metrics] * n, [n_utts] * n, [block] * n
+    if workers == 1:
+        results = list(map(run_replicate, *args))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(run_replicate, *args))
+    columns = {"sim": [], "utts": [], **{name: [] for name in metrics}}
+    for sim, result in enumerate(results):
+        columns["sim"].extend([sim] * len(result["utts"]))
+        for name, values in result.items():
+            columns[name].extend(values)
+    return pd.DataFrame(columns)
+
+
+def run_replicate(corpus, seed, params, metrics, n_utts, block):
+    ltm = new_ltm()
+    sample = sample_corpus(corpus, n_utts, seed)
+    result = {"utts": [0], **{name: [metric(ltm)] for name, metric in metrics.items()}}
+    for start, end in iter_blocks(n_utts, block):
+        if isinstance(corpus, Corpus):
+            learn(corpus.take(sample[start:end]), ltm, **params)
+        else:
+            learn([corpus[i] for i in sample[start:end].tolist()], ltm, **params)
+        result["utts"].append(end)
+        for name, metric in metrics.items():
+            result[name].append(metric(ltm))
+    return result
+
+
+def sample_corpus(corpus, n_utts, seed=None):
+    # Indices of n_utts utterances drawn with replacement
+    return np.random.default_rng(seed).integers(len(corpus), size=n_utts)
+
+
+def iter_blocks(n, block):
+    # Bounds of consecutive blocks covering range(n), with a shorter last block
+    for start in range(0, n, block):
+        yield start, min(start + block, n)
+
+
+def sweep(corpus, grid, metrics=None, workers=None, path=None):
+    # Train one model per point of a parameter grid (a dict of value lists or a list
+    # of dicts), streaming each result to the table (and path) as the run finishes.
+    # Workers read the tokenized corpus from shared memory.
+    if isinstance(grid, dict):
+        points = [dict(zip(grid, values)) for values in product(*grid.values())]
+    else:
+        points = [dict(point) for point in grid]
+    metrics = {"ltm_size": len} if metrics is None else metrics
+    if isinstance(corpus, (str, PathLike)):
+        corpus = load_corpus(compile_corpus(corpus))
+    elif not isinstance(corpus, Corpus):
+        corpus = new_corpus(corpus)
+    names = list(dict.fromkeys(name for point in points for name in point))
+    columns = ["run", *names, *metrics]
+    rows = []
+    with open(path, "w", newline="") if path else nullcontext() as f:
+        writer = None
+        if f is not None:
+            writer = csv.DictWriter(f, columns)
+            writer.writeheader()
+        for row in sweep_runs(corpus, points, metrics, workers):
+            rows.append(row)
+            if writer is not None:
+                writer.writerow(row)
+                f.flush()
+    rows.sort(key=lambda row: row["run"])
+    return pd.DataFrame(rows, columns=columns)
+
+
+def sweep_runs(corpus, points, metrics, workers):
+    if workers == 1:
+        for run, point in enumerate(points):
+            yield sweep_run(corpus, run, point, metrics)
+        return
+    # Workers map a compiled corpus, otherwise it is copied to shared memory
+    shm, handle = (None, corpus.path) if corpus.path else corpus.share()
+    try:
+        with ProcessPoolExecutor(
+            workers, initializer=attach_corpus, initargs=(handle,)
+        ) as pool:
+            futures = [
+                pool.submit(sweep_run, None, run, point, metrics)
+                for run, point in enumerate(points)
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def sweep_run(corpus, run, point, metrics):
+    ltm = new_ltm()
+    learn(worker_corpus if corpus is None else corpus, ltm, **point)
+    return {
+        "run": run,
+        **point,
+        **{name: metric(ltm) for name, metric in metrics.items()},
+    }
+
+
+worker_corpus = None  # Corpus attached by each sweep worker
+
+
+def attach_corpus(handle):
+    global worker_corpus
+    if isinstance(handle, str):
+        worker_corpus = load_corpus(handle)
+    else:
+        worker_corpus = Corpus.attach(handle)
+
+
+def run_branches(prefix, branches, ltm=None, params=None, metrics=None, workers=None):
+    # Train LTM on the prefix once, then continue a copy of it on each branch (a dict
+    # of corpora by name, or a list). Forked workers share the prefix LTM with the
+    # parent, otherwise it is pickled to each worker once.
+    ltm = new_ltm() if ltm is None else ltm
+    params = {} if params is None else params
+    metrics = {"ltm_size": len} if metrics is None else metrics
+    learn(prefix, ltm, **params)
+    if not isinstance(branches, dict):
+        branches = dict(enumerate(branches))
+    args = list(branches), list(branches.values()), [params] * len(branches)
+    if workers == 1:
+        results = [run_branch(*task, metrics, ltm) for task in zip(*args)]
+    else:
+        with ProcessPoolExecutor(
+            workers, mp_context=fork_context(), initializer=attach_ltm, initargs=(ltm,)
+        ) as pool:
+            results = list(pool.map(run_branch, *args, [metrics] * len(branches)))
+    return pd.DataFrame(results, columns=["branch", *metrics])
+
+
+def run_branch(branch, corpus, params, metrics, ltm=None):
+    ltm = copy_ltm(worker_ltm if ltm is None else ltm)
+    learn(corpus, ltm, **params)
+    return {"branch": branch, **{name: metric(ltm) for name, metric in metrics.items()}}
+
+
+worker_ltm = None  # Prefix LTM attached by each branch worker
+
+
+def attach_ltm(ltm):
+    global worker_ltm
+    worker_ltm = ltm
+
+
+def copy_ltm(ltm):
+    return ltm.copy() if isinstance(ltm, (dict, LTM)) else dict(ltm)
+
+
+def fork_context():
+    # Forked workers share the parent's memory until they write to it
+    return get_context("fork") if "fork" in get_all_start_methods() else None
+
+
+class VocabTracker:
+    # Number and total PT of the target words in LTM, kept up to date by learn
+    def __init__(self, words, ltm=None):
+        self.words = set(words)
+        self.count = 0
+        self.total = 0.0
+        if ltm is not None:
+            for word in self.words:
+                if word in ltm:
+                    self.add(word, ltm[word])
+
+    def add(self, chunk, pt):
+        if chunk in self.words:
+            self.count += 1
+            self.total += pt
+
+    def update(self, chunk, pt_old, pt_new):
+        if chunk in self.words:
+            self.total += pt_new - pt_old
+
+    def size(self):
+        return self.count
+
+    def mean_pt(self):
+        return self.total / self.count if self.count else 0
+
+
+def new_tracker(words, ltm=None):
+    return VocabTracker(words, ltm)
+
+
+def vocab_size(ltm, words):
+    return sum(1 for word in words if word in ltm)
+
+
+def vocab_pt(ltm, words):
+    pt = [ltm[word] for word in words if word in ltm]
+    return mean(pt) if pt else 0
+
+
+def read_corpus(source, *stages):
+    # Lazily yield the utterances in a file path, open file or iterable, passing each
+    # through the stages in turn. A stage can return None to drop the utterance.
+    if isinstance(source, (str, PathLike)):
+        with open(source) as f:
+            yield from read_corpus(f, *stages)
+        return
+    for utt in source:
+        if isinstance(utt, str):
+            utt = utt.rstrip("\r\n")
+        for stage in stages:
+            utt = stage(utt)
+            if utt is None:
+                break
+        else:
+            yield utt
+
+
+def strip_brackets(utt):
+    return utt.replace("[", "").replace("]", "")
+
+
+def new_corpus(utterances):
+    symbols, codes, tokens, offsets = [], {}, array("I"), array("q", [0])
+    for utt in utterances:
+        for element in utt.split() if isinstance(utt, str) else utt:
+            code = codes.get(element)
+            if code is None:
+                code = codes[element] = len(symbols)
+                symbols.append(element)
+            tokens.append(code)
+        offsets.append(len(tokens))
+    return Corpus(
+        symbols, np.frombuffer(tokens, np.uint32), np.frombuffer(offsets, np.int64)
     )
 
 
-def new_ltm():
-    return {}
+class Corpus:
+    # Tokenized corpus: utterance i is tokens[offsets[i]:offsets[i + 1]], with each
+    # token a code into symbols
+    __slots__ = ("symbols", "lookup", "tokens", "offsets", "buffer", "path")
+
+    def __init__(self, symbols, tokens, offsets, buffer=None, path=None):
+        self.symbols = symbols
+        self.lookup = np.array(symbols, dtype=object)
+        self.tokens = tokens
+        self.offsets = offsets
+        self.buffer = buffer  # Keeps the shared or mapped memory open for the arrays
+        self.path = path
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return " ".join(self.stream(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self):
+        # A compiled corpus is sent to other processes as its path and mapped again
+        if self.path is not None:
+            return load_corpus, (self.path,)
+        return Corpus, (self.symbols, self.tokens, self.offsets)
+
+    def stream(self, i):
+        i = range(len(self))[i]
+        symbols = self.symbols
+        codes = self.tokens[self.offsets[i] : self.offsets[i + 1]].tolist()
+        return [symbols[code] for code in codes]
+
+    def streams(self, block=4096):
+        # Look up the symbols for a block of utterances at a time
+        for start, end in iter_blocks(len(self), block):
+            offsets = self.offsets[start : end + 1].tolist()
+            base = offsets[0]
+            elements = self.lookup[self.tokens[base : offsets[-1]]].tolist()
+            for i in range(end - start):
+                yield elements[offsets[i] - base : offsets[i + 1] - base]
+
+    def take(self, indices):
+        # Streams of the utterances at the given indices, gathered in one lookup
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0)
+        positions += np.repeat(starts - (ends - lengths), lengths)
+        elements = self.lookup[self.tokens[positions]].tolist()
+        ends = ends.tolist()
+        return [elements[end - n : end] for end, n in zip(ends, lengths.tolist())]
+
+    def share(self):
+        # Copy the arrays into shared memory, returning it and a handle to attach
+        n_tokens, n_offsets = len(self.tokens), len(self.offsets)
+        shm = SharedMemory(create=True, size=max(1, 4 * n_tokens + 8 * n_offsets))
+        handle = shm.name, self.symbols, n_tokens, n_offsets
+        corpus = Corpus.attach(handle, shm)
+        corpus.tokens[:] = self.tokens
+        corpus.offsets[:] = self.offsets
+        return shm, handle
+
+    @staticmethod
+    def attach(handle, shm=None):
+        name, symbols, n_tokens, n_offsets = handle
+        if shm is None:
+            shm = SharedMemory(name, track=False)
+        offsets = np.ndarray(n_offsets, np.int64, shm.buf)
+        tokens = np.ndarray(n_tokens, np.uint32, shm.buf, offset=8 * n_offsets)
+        return Corpus(symbols, tokens, offsets, shm)
+
+
+# Compiled corpus header: magic, version, source hash, symbol bytes, offsets, tokens
+CORPUS_HEADER = struct.Struct("<8sI32sQQQ")
+CORPUS_MAGIC = b"CIPALCRP"
+CORPUS_VERSION = 1
+
+
+# Values that repr the same in every process, so they can be hashed by their repr
+PLAIN_TYPES = (type(None), bool, int, float, str, bytes, tuple, frozenset)
+
+
+def hash_stage(stage, digest, seen=()):
+    # Hash what a stage does rather than only its name: the arguments bound by a
+    # partial, and the code, defaults, closure cells and plain global values of a
+    # function. Other values enter by repr, which at worst compiles again.
+    if stage in seen:
+        return  # A nested function that calls itself
+    seen = (*seen, stage)
+    if isinstance(stage, partial):
+        hash_stage(stage.func, digest, seen)
+        digest.update(repr((stage.args, sorted(stage.keywords.items()))).encode())
+        return
+    module = getattr(stage, "__module__", None) or type(stage).__module__
+    name = getattr(stage, "__qualname__", None) or type(stage).__qualname__
+    digest.update(f"{module}.{name}".encode())
+    code = getattr(stage, "__code__", None)
+    if code is None:
+        return
+    hash_code(code, digest)
+    digest.update(repr((stage.__defaults__, stage.__kwdefaults__)).encode())
+    for cell in stage.__closure__ or ():
+        value = cell.cell_contents
+        if callable(value):
+            hash_stage(value, digest, seen)
+        else:
+            digest.update(repr(value).encode())
+    for key in code.co_names:
+        value = stage.__globals__.get(key)
+        if isinstance(value, PLAIN_TYPES):
+            digest.update(repr((key, value)).encode())
+
+
+def hash_code(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            hash_code(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+def compile_corpus(source, path=None, stages=()):
+    # Tokenize a text corpus into a binary file, unless the file was already compiled
+    # from the same source and stages
+    path = f"{fspath(source)}.cipal" if path is None else fspath(path)
+    digest = sha256()
+    with open(source, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    for stage in stages:
+        hash_stage(stage, digest)
+    digest = digest.digest()
+    try:
+        with open(path, "rb") as f:
+            header = f.read(CORPUS_HEADER.size)
+    except OSError:
+        header = b""
+    if len(header) == CORPUS_HEADER.size:
+        if CORPUS_HEADER.unpack(header)[:3] == (CORPUS_MAGIC, CORPUS_VERSION, digest):
+            return path
+    corpus = new_corpus(read_corpus(source, *stages))
+    symbols = "\n".join(corpus.symbols).encode()
+    header = CORPUS_HEADER.pack(
+        CORPUS_MAGIC,
+        CORPUS_VERSION,
+        digest,
+        len(symbols),
+        len(corpus.offsets),
+        len(corpus.tokens),
+    )
+    padding = -(len(header) + len(symbols)) % 8  # Align the offsets to 8 bytes
+    # Write to a temporary file first, so other processes never map a partial file
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(header)
+        f.write(symbols)
+        f.write(bytes(padding))
+        f.write(corpus.offsets.tobytes())
+        f.write(corpus.tokens.tobytes())
+    replace(f"{path}.tmp", path)
+    return path
+
+
+def load_corpus(path):
+    path = fspath(path)
+    with open(path, "rb") as f:
+        buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+    header = buffer[: CORPUS_HEADER.size]
+    if not header.startswith(CORPUS_MAGIC) or len(header) < CORPUS_HEADER.size:
+        raise ValueError(f"Not a compiled corpus: {path}")
+    magic, version, digest, n_bytes, n_offsets, n_tokens = CORPUS_HEADER.unpack(header)
+    if version != CORPUS_VERSION:
+        raise ValueError(f"Unsupported compiled corpus version: {version}")
+    start = CORPUS_HEADER.size
+    symbols = buffer[start : start + n_bytes].decode().split("\n") if n_bytes else []
+    start += n_bytes + (-(start + n_bytes) % 8)
+    offsets = np.frombuffer(buffer, np.int64, n_offsets, start)
+    tokens = np.frombuffer(buffer, np.uint32, n_tokens, start + 8 * n_offsets)
+    return Corpus(symbols, tokens, offsets, buffer, path)
+
+
+def new_ltm(columnar=False):
+    return LTM() if columnar else {}
+
+
+class LTM(MutableMapping):
+    # LTM that maps each chunk to a dense slot, with the PTs in a float64 array.
+    # Chunks are never removed, so the slots follow the insertion order.
+    # It costs more per chunk than a dict (a slot int plus the 8 byte PT
+    # against one float) and is slower to learn with; use it for export.
+    __slots__ = ("slots", "pt", "snapshots")
+
+    def __init__(self, items=()):
+        self.slots = {}
+        self.pt = array("d")
+        self.snapshots = {}
+        self.update(items)
+
+    def __getstate__(self):
+        return self.slots, self.pt
+
+    def __setstate__(self, state):
+        self.slots, self.pt = state
+        self.snapshots = {}
+
+    def __getitem__(self, chunk):
+        return self.pt[self.slots[chunk]]
+
+    def __setitem__(self, chunk, pt):
+        slot = self.slots.get(chunk)
+        if slot is None:
+            self.add(chunk, pt)
+        else:
+            if self.snapshots:
+                self.save(slot)
+            self.pt[slot] = pt
+
+    def __delitem__(self, chunk):
+        raise TypeError("Chunks cannot be removed from LTM")
+
+    def __contains__(self, chunk):
+        return chunk in self.slots
+
+    def __iter__(self):
+        return iter(self.slots)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __repr__(self):
+        return f"LTM({dict(self.items())})"
+
+    def get(self, chunk, default=None):
+        slot = self.slots.get(chunk)
+        return default if slot is None else self.pt[slot]
+
+    def setdefault(self, chunk, default=None):
+        slot = self.slots.get(chunk)
+        if slot is None:
+            return self.add(chunk, default)
+        return self.pt[slot]
+
+    def add(self, chunk, pt):
+        try:
+            self.pt.append(pt)
+        except BufferError:
+            # Leave exported arrays on the old buffer and grow a copy
+            self.pt = array("d", self.pt)
+            self.pt.append(pt)
+        self.slots[chunk] = len(self.slots)
+        return self.pt[-1]
+
+    def to_numpy(self, writeable=False):
+        # View of the PTs, which stops following LTM once it grows
+        pt = np.frombuffer(self.pt, dtype=np.float64)
+        pt.flags.writeable = writeable
+        return pt
+
+    def copy(self):
+        ltm = LTM()
+        ltm.slots = self.slots.copy()
+        ltm.pt = array("d", self.pt)
+        return ltm
+
+    def snapshot(self):
+        # Read-only view of LTM as it is now. Later changes keep the old PTs in
+        # the snapshot, so it only grows with the chunks changed since.
+        snapshot = LTMSnapshot(self)
+        key = id(snapshot)
+        self.snapshots[key] = ref(snapshot, lambda _: self.snapshots.pop(key, None))
+        return snapshot
+
+    def save(self, slot):
+        for snapshot in list(self.snapshots.values()):
+            snapshot = snapshot()
+            if snapshot is not None and slot < snapshot.size:
+                snapshot.undo.setdefault(slot, self.pt[slot])
+
+
+class LTMSnapshot(Mapping):
+    # Only sees changes made through the LTM mapping, not through writeable
+    # views from to_numpy
+    def __init__(self, ltm):
+        self.ltm = ltm
+        self.size = len(ltm)
+        self.undo = {}
+
+    def __getitem__(self, chunk):
+        slot = self.ltm.slots[chunk]
+        if slot >= self.size:
+            raise KeyError(chunk)
+        pt = self.undo.get(slot)
+        return self.ltm.pt[slot] if pt is None else pt
+
+    def __contains__(self, chunk):
+        slot = self.ltm.slots.get(chunk)
+        return slot is not None and slot < self.size
+
+    def __iter__(self):
+        return islice(self.ltm.slots, self.size)
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"LTMSnapshot({dict(self.items())})"
+
+    def to_numpy(self):
+        pt = np.frombuffer(self.ltm.pt, dtype=np.float64, count=self.size).copy()
+        if self.undo:
+            pt[list(self.undo)] = list(self.undo.values())
+        return pt
 
 
 def new_stm():
     return {"chunks": [], "process": [], "decay": []}
 
 
+class STM(dict):
+    # STM hash table whose lists are reused across ticks and filtered in place
+    __slots__ = ("parsed", "generation")
+
+    def __init__(self):
+        super().__init__(chunks=[], process=[], decay=[])
+        self.parsed = 0
+        self.generation = None
+
+    def clear(self):
+        for field in self.values():
+            field.clear()
+        self.parsed = 0
+
+    def truncate(self, size):
+        for field in self.values():
+            del field[size:]
+
+    def parsed_chunks(self, ltm):
+        # Number of leading chunks parsed while LTM had its current keys. Chunks are
+        # never removed from LTM, so its size tells when a parse is out of date.
+        return self.parsed if self.generation == len(ltm) else 0
+
+    def mark_parsed(self, ltm):
+        self.parsed = len(self["chunks"])
+        self.generation = len(ltm)
+
+
+class ChunkIndex:
+    # Prefix trie over the chunks in LTM with two or more elements. Its elements are
+    # numbered as small ints and so are the trie nodes, so the whole trie is one flat
+    # dict from (node << 32 | symbol) to the child node. The child is stored shifted
+    # left by one, with the low bit set if a chunk ends there. Like a parse cache, the
+    # index belongs to one LTM at one size. learn does not update it, so find_chunks
+    # ignores it once that LTM has grown, until update is called.
+    def __init__(self, ltm):
+        self.symbols = {}
+        self.edges = {}
+        self.size = 0
+        self.ltm = ltm.ltm if isinstance(ltm, LTMSnapshot) else ltm
+        self.generation = 0
+        self.update(ltm)
+
+    def __contains__(self, chunk):
+        child = 0
+        for symbol in self.encode([chunk])[0]:
+            child = self.edges.get(child >> 1 << 32 | symbol)
+            if child is None:
+                return False
+        return bool(child & 1)
+
+    def __len__(self):
+        return self.size
+
+    def matches(self, ltm):
+        owner = ltm.ltm if isinstance(ltm, LTMSnapshot) else ltm
+        return owner is self.ltm and len(ltm) == self.generation
+
+    def update(self, ltm):
+        # Add the chunks that LTM gained since the index was built or last updated
+        owner = ltm.ltm if isinstance(ltm, LTMSnapshot) else ltm
+        if owner is not self.ltm:
+            raise ValueError("The index was built from another LTM")
+        for chunk in islice(ltm, self.generation, None):
+            self.add(chunk)
+        self.generation = len(ltm)
+
+    def add(self, chunk):
+        elements = chunk.split()
+        if len(elements) < 2:
+            return
+        symbols, edges = self.symbols, self.edges
+        node = 0
+        for element in elements:
+            symbol = symbols.get(element)
+            if symbol is None:
+                symbol = symbols[element] = len(symbols)
+            key = node << 32 | symbol
+            child = edges.get(key)
+            if child is None:
+                child = edges[key] = (len(edges) + 1) << 1
+            node = child >> 1
+        if not child & 1:
+            edges[key] = child | 1
+            self.size += 1
+
+    def encode(self, chunks):
+        # Symbols of the elements in each chunk, with -1 for elements that are in no
+        # indexed chunk. Only chunks of more than one element are split.
+        get = self.symbols.get
+        return [
+            [get(element, -1) for element in chunk.split()]
+            if " " in chunk
+            else [get(chunk, -1)]
+            for chunk in chunks
+        ]
+
+
+def new_index(ltm):
+    return ChunkIndex(ltm)
+
+
+class ParseCache:
+    # Bounded LRU cache of recodes for one LTM, cleared whenever that LTM gains a
+    # chunk or the cache is used with another one. It keeps a reference to the LTM
+    # so that no other LTM can be mistaken for it. In learn, LTM gains a chunk on
+    # most ticks, so few recodes are ever reused there. The cache is for parsing
+    # many items against an LTM that is not learning.
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.recodes = OrderedDict()
+        self.ltm = None
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.recodes)
+
+    def get(self, key, ltm):
+        # A snapshot has the chunks its LTM had at the snapshot's size
+        owner = ltm.ltm if isinstance(ltm, LTMSnapshot) else ltm
+        if owner is not self.ltm or len(ltm) != self.generation:
+            self.recodes.clear()
+            self.ltm = owner
+            self.generation = len(ltm)
+        recode = self.recodes.get(key)
+        if recode is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.recodes.move_to_end(key)
+        return recode
+
+    def put(self, key, recode):
+        self.recodes[key] = recode
+        if len(self.recodes) > self.maxsize:
+            self.recodes.popitem(last=False)
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / calls if calls else 0.0,
+            "size": len(self.recodes),
+            "maxsize": self.maxsize,
+        }
+
+
+def new_cache(maxsize=100000):
+    return ParseCache(maxsize)
+
+
 def check_stm(stm):
     if not (len(stm["chunks"]) == len(stm["process"]) == len(stm["decay"])):
         raise ValueError("STM fields have different lengths.")
 
 
-def learn_element(element, ltm, pt_initial):
+def learn_element(element, ltm, pt_initial, tracker=None):
+    if tracker is not None and element not in ltm:
+        tracker.add(element, pt_initial)
     ltm.setdefault(element, pt_initial)
 
 
@@ -87,7 +1240,7 @@ def add_to_stm(element, stm, ltm, time_t, decay_rate):
     check_stm(stm)
 
 
-def learn_chunks(ltm, stm, time_t):
+def learn_chunks(ltm, stm, time_t, tracker=None):
     chunks_rev = stm["chunks"][::-1]
     process_rev = stm["process"][::-1]
     unused = [True] * len(chunks_rev)
@@ -101,10 +1254,52 @@ def learn_chunks(ltm, stm, time_t):
             new_c = f"{chunks_rev[j]} {chunks_rev[j - 1]}"
             if new_c not in ltm:
                 ltm[new_c] = (ltm[chunks_rev[j]] + ltm[chunks_rev[j - 1]]) / 2
+                if tracker is not None:
+                    tracker.add(new_c, ltm[new_c])
                 unused[j] = unused[j - 1] = False
 
 
-def find_chunks(stm_chunks, ltm):
+def find_chunks(stm_chunks, ltm, index=None, parsed=0, cache=None):
+    # The recode only depends on which chunks are in LTM (not on their PTs). Chunks
+    # are never removed from LTM, so its size tells the cache when the stored recodes
+    # for that LTM are out of date.
+    if cache is not None:
+        key = tuple(stm_chunks)
+        recode = cache.get(key, ltm)
+        if recode is None:
+            recode = tuple(find_chunks(stm_chunks, ltm, index, parsed))
+            cache.put(key, recode)
+        return list(recode)
+    # A chunk index walks a trie rather than joining each window, which pays off for
+    # long sequences. learn does not keep one, as updating the trie for each new chunk
+    # costs more than it saves on sequences as short as STM. An index that is out of
+    # date for this LTM is not used.
+    if index is not None and index.matches(ltm):
+        codes = index.encode(stm_chunks)
+        n_chunks = len(codes)
+        # A parsed STM cannot be recoded further, so only the sequences that end
+        # with a chunk added since the last parse need to be checked
+        if parsed >= n_chunks:
+            spans = []
+        elif parsed == n_chunks - 1:
+            spans = find_suffix(codes, index)
+        else:
+            spans = find_spans(codes, index)
+        return recode_spans(spans, n_chunks)
+    # Without an index, only the windows that end with the new chunk are joined. The
+    # longest one stored gets the first chunk id and the chunks before it count up
+    # from right to left.
+    n_chunks = len(stm_chunks)
+    if parsed and parsed >= n_chunks - 1:
+        start_index = n_chunks
+        if parsed == n_chunks - 1:
+            for j in range(n_chunks - 1):
+                if " ".join(stm_chunks[j:]) in ltm:
+                    start_index = j
+                    break
+        if start_index == n_chunks:
+            return list(range(n_chunks, 0, -1))
+        return list(range(start_index + 1, 1, -1)) + [1] * (n_chunks - start_index)
     recode = [0] * len(stm_chunks)
     start_index, end_index, chunk_id, adjust = 0, len(stm_chunks), 1, 0
     while 0 in recode:
@@ -134,11 +1329,71 @@ def find_chunks(stm_chunks, ltm):
     return recode
 
 
+def find_spans(codes, index):
+    # Walk the trie from each chunk to find every longer sequence stored in LTM
+    spans = []
+    edges = index.edges
+    n_chunks = len(codes)
+    for start_index in range(n_chunks - 1):
+        node = 0
+        for end_index in range(start_index, n_chunks):
+            for symbol in codes[end_index]:
+                child = edges.get(node << 32 | symbol)
+                if child is None:
+                    break
+                node = child >> 1
+            else:
+                if child & 1 and end_index > start_index:
+                    spans.append((end_index + 1 - start_index, start_index))
+                continue
+            break
+    return spans
+
+
+def find_suffix(codes, index):
+    # Find the longest stored sequence that ends with the last chunk
+    edges = index.edges
+    n_chunks = len(codes)
+    for start_index in range(n_chunks - 1):
+        node = child = 0
+        for code in islice(codes, start_index, None):
+            for symbol in code:
+                child = edges.get(node << 32 | symbol)
+                if child is None:
+                    break
+                node = child >> 1
+            else:
+                continue
+            break
+        else:
+            if child & 1:
+                return [(n_chunks - start_index, start_index)]
+    return []
+
+
+def recode_spans(spans, n_chunks):
+    # Longest sequences first, then from right to left (as in find_chunks)
+    recode = [0] * n_chunks
+    chunk_id = 1
+    for length, start_index in sorted(spans, reverse=True):
+        end_index = start_index + length
+        if not any(recode[start_index:end_index]):
+            recode[start_index:end_index] = [chunk_id] * length
+            chunk_id += 1
+    for j in range(n_chunks - 1, -1, -1):
+        if recode[j] == 0:
+            recode[j] = chunk_id
+            chunk_id += 1
+    return recode
+
+
 def compress_stm(recode, stm, ltm, time_t):
+    if isinstance(stm, STM):
+        return compress_stm_inplace(recode, stm, ltm, time_t)
     stm_recode = {"chunks": [], "process": [], "decay": []}
     unique_indices = list(dict.fromkeys(recode))  # Preserve the original index order
-    for index in unique_indices:
-        chunk_indices = [j for j, idx in enumerate(recode) if idx == index]
+    for chunk_id in unique_indices:
+        chunk_indices = [j for j, idx in enumerate(recode) if idx == chunk_id]
         chunk = " ".join([stm["chunks"][j] for j in chunk_indices])
         stm_recode["chunks"].append(chunk)
         # Make no changes to the timings that have not been recoded
@@ -153,7 +1408,110 @@ def compress_stm(recode, stm, ltm, time_t):
     return stm_recode
 
 
+def compress_stm_inplace(recode, stm, ltm, time_t):
+    # Merge each run of recode indices into the next free slot of the buffers
+    n_chunks = len(recode)
+    if max(recode, default=0) == n_chunks:
+        return stm  # Nothing to recode
+    chunks, process, decay = stm["chunks"], stm["process"], stm["decay"]
+    size = start_index = 0
+    for end_index in range(1, n_chunks + 1):
+        if end_index < n_chunks and recode[end_index] == recode[start_index]:
+            continue
+        if end_index - start_index == 1:
+            chunks[size] = chunks[start_index]
+            process[size] = process[start_index]
+            decay[size] = decay[start_index]
+        else:
+            chunk = " ".join(chunks[start_index:end_index])
+            chunks[size] = chunk
+            process[size] = ltm[chunk] + time_t
+            decay[size] = decay[end_index - 1]
+        size += 1
+        start_index = end_index
+    stm.truncate(size)
+    check_stm(stm)
+    return stm
+
+
+def learn_step(ltm, stm, time_t, tracker=None):
+    # learn_chunks, find_chunks and compress_stm in one pass over the STM buffers
+    chunks, process, decay = stm["chunks"], stm["process"], stm["decay"]
+    n_chunks = len(chunks)
+    # Pair up processed chunks from right to left, using each chunk at most once
+    used = False
+    for j in range(n_chunks - 2, -1, -1):
+        if used:
+            used = False
+        elif time_t >= process[j] and time_t >= process[j + 1]:
+            new_c = f"{chunks[j]} {chunks[j + 1]}"
+            if new_c not in ltm:
+                ltm[new_c] = (ltm[chunks[j]] + ltm[chunks[j + 1]]) / 2
+                if tracker is not None:
+                    tracker.add(new_c, ltm[new_c])
+                used = True
+    # Find the sequences stored in LTM, longest first and then from right to left.
+    # If the LTM keys are unchanged since the last parse, only the sequences that end
+    # with the newest chunk can be stored.
+    parsed = stm.parsed_chunks(ltm)
+    spans = {}
+    if parsed == n_chunks - 1:
+        for start_index in range(n_chunks - 1):
+            chunk = " ".join(chunks[start_index:])
+            if chunk in ltm:
+                spans[start_index] = (n_chunks, chunk)
+                break
+    elif parsed < n_chunks:
+        taken = 0  # Bit mask of the chunks already in a sequence
+        for length in range(n_chunks, 1, -1):
+            for start_index in range(n_chunks - length, -1, -1):
+                mask = ((1 << length) - 1) << start_index
+                if not taken & mask:
+                    end_index = start_index + length
+                    chunk = " ".join(chunks[start_index:end_index])
+                    if chunk in ltm:
+                        taken |= mask
+                        spans[start_index] = (end_index, chunk)
+    # Merge each sequence into the next free slot of the buffers
+    if spans:
+        size = start_index = 0
+        while start_index < n_chunks:
+            span = spans.get(start_index)
+            if span is None:
+                chunks[size] = chunks[start_index]
+                process[size] = process[start_index]
+                decay[size] = decay[start_index]
+                start_index += 1
+            else:
+                end_index, chunk = span
+                chunks[size] = chunk
+                process[size] = ltm[chunk] + time_t
+                decay[size] = decay[end_index - 1]
+                start_index = end_index
+            size += 1
+        stm.truncate(size)
+        check_stm(stm)
+    stm.mark_parsed(ltm)
+    return stm
+
+
 def decay_stm(stm, time_t):
+    if isinstance(stm, STM):
+        chunks, process, decay = stm["chunks"], stm["process"], stm["decay"]
+        size = 0
+        for j, decay_time in enumerate(decay):
+            if time_t < decay_time:
+                if size != j:
+                    chunks[size] = chunks[j]
+                    process[size] = process[j]
+                    decay[size] = decay_time
+                size += 1
+            elif size:
+                stm.parsed = 0  # The chunks either side are now next to each other
+        if size < len(decay):
+            stm.parsed = max(0, stm.parsed - (len(decay) - size))
+            stm.truncate(size)
+        return stm
     active_chunks = [time_t < decay_time for decay_time in stm["decay"]]
     stm_active = {
         "chunks": [
@@ -174,13 +1532,251 @@ def pt_sigmoid(pt, mid):
     return (0.8 / (1 + exp((mid - pt) / (mid * 0.2)))) + 0.2
 
 
-def adjust_pt(ltm, stm, pt_adjust, pt_initial, pt_ceiling):
+def adjust_pt(ltm, stm, pt_adjust, pt_initial, pt_ceiling, tracker=None):
     for chunk in stm["chunks"]:
+        pt = ltm[chunk]
         ltm[chunk] = max(
-            ltm[chunk] + (-abs(pt_adjust) * pt_sigmoid(ltm[chunk], pt_initial / 2)),
+            pt + (-abs(pt_adjust) * pt_sigmoid(pt, pt_initial / 2)), pt_ceiling
+        )
+        if tracker is not None:
+            tracker.update(chunk, pt, ltm[chunk])
+
+
+def adjust_pt_ticks(ltm, stm, n_ticks, pt_adjust, pt_initial, pt_ceiling, tracker=None):
+    # adjust_pt over n_ticks ticks with the same STM. Each PT only depends on its own
+    # chunk, so all the adjustments to a chunk are made in one loop, with the same
+    # arithmetic as adjust_pt. A PT at the ceiling stays there.
+    step = -abs(pt_adjust)
+    mid = pt_initial / 2
+    scale = mid * 0.2
+    for chunk, count in Counter(stm["chunks"]).items():
+        pt = ltm[chunk]
+        for _ in range(count * n_ticks):
+            if pt == pt_ceiling:
+                break
+            pt_new = max(
+                pt + (step * ((0.8 / (1 + exp((mid - pt) / scale))) + 0.2)), pt_ceiling
+            )
+            if tracker is not None:
+                tracker.update(chunk, pt, pt_new)
+            pt = pt_new
+        ltm[chunk] = pt
+
+
+def pt_sigmoid_batch(pt, mid):
+    return (0.8 / (1 + np.exp((mid - pt) / (mid * 0.2)))) + 0.2
+
+
+def adjust_pt_batch(pt, slots, pt_adjust, pt_initial, pt_ceiling):
+    # adjust_pt over an array of PTs, where slots index the chunks in STM. A chunk
+    # that is in STM more than once is adjusted once for each copy, as in adjust_pt.
+    slots, counts = np.unique(np.asarray(slots, dtype=np.intp), return_counts=True)
+    while slots.size:
+        values = pt[slots]
+        pt[slots] = np.maximum(
+            values - abs(pt_adjust) * pt_sigmoid_batch(values, pt_initial / 2),
             pt_ceiling,
         )
+        counts -= 1
+        slots, counts = slots[counts > 0], counts[counts > 0]
+    return pt
+
+
+def ltm_to_df(ltm, copy=True, lengths=False):
+    return pd.DataFrame(ltm_columns(ltm, copy, lengths), copy=False)
+
+
+def ltm_columns(ltm, copy=True, lengths=False):
+    # Chunks and PTs as a list and an array, without building (chunk, PT) pairs,
+    # plus the number of elements in each chunk if lengths is set
+    if isinstance(ltm, LTM):
+        chunks = list(ltm.slots)
+        pt = ltm.to_numpy()
+        pt = pt.copy() if copy else pt
+    elif isinstance(ltm, LTMSnapshot):
+        chunks = list(ltm)
+        pt = ltm.to_numpy()
+    else:
+        chunks = list(ltm)
+        pt = np.fromiter(ltm.values(), np.float64, len(ltm))
+    columns = {"chunks": chunks, "pt": pt}
+    if lengths:
+        spaces = np.fromiter(map(str.count, chunks, repeat(" ")), np.int64, len(chunks))
+        columns["length"] = spaces + 1
+    return columns
+
+
+def export_ltm(ltm, path, lengths=False):
+    # Write LTM to a Parquet or Feather file (by the path suffix), building the Arrow
+    # columns straight from the chunks and the PT array. Needs pyarrow.
+    import pyarrow as pa
+
+    path = fspath(path)
+    columns = ltm_columns(ltm, copy=False, lengths=lengths)
+    columns["chunks"] = pa.array(columns["chunks"], pa.string())
+    table = pa.table(columns)
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        pq.write_table(table, path)
+    elif path.endswith((".feather", ".arrow")):
+        import pyarrow.feather as feather
+
+        feather.write_feather(table, path)
+    else:
+        raise ValueError(f"Expected a .parquet or .feather path but got {path}")
+
+
+# LTM file header: magic, version, chunks, chunks per restart block, key bytes
+LTM_HEADER = struct.Struct("<8sIQIQ")
+LTM_MAGIC = b"CIPALLTM"
+LTM_VERSION = 1
+
+
+def save_ltm(ltm, path, restart=16):
+    # Write the chunks in sorted order, each as the number of characters it shares
+    # with the previous chunk plus the rest. Every block of restart chunks starts
+    # from scratch so that single chunks can be looked up in the file.
+    chunks = list(ltm)
+    n_chunks = len(chunks)
+    if n_chunks >= 1 << 32:
+        raise ValueError("LTM has too many chunks to save")
+    pt = np.fromiter(ltm.values(), np.float64, n_chunks)
+    order = sorted(range(n_chunks), key=chunks.__getitem__)
+    shared, suffix, text, keys, blocks = [], [], [], [], [0]
+    for i, j in enumerate(order):
+        chunk = chunks[j]
+        previous = "" if i % restart == 0 else chunks[order[i - 1]]
+        n_shared = 0
+        n_max = min(len(previous), len(chunk))
+        while n_shared < n_max and previous[n_shared] == chunk[n_shared]:
+            n_shared += 1
+        shared.append(n_shared)
+        suffix.append(len(chunk) - n_shared)
+        text.append(chunk[n_shared:])
+        if i % restart == restart - 1 or i == n_chunks - 1:
+            keys.append("".join(text).encode())
+            blocks.append(blocks[-1] + len(keys[-1]))
+            text = []
+    if max(suffix, default=0) >= 1 << 16 or max(shared, default=0) >= 1 << 16:
+        raise ValueError("LTM has chunks too long to save")
+    keys = b"".join(keys)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(LTM_HEADER.pack(LTM_MAGIC, LTM_VERSION, n_chunks, restart, len(keys)))
+        f.write(pt[order].tobytes())
+        f.write(np.array(blocks, np.uint64).tobytes())
+        f.write(np.array(order, np.uint32).tobytes())
+        f.write(np.array(shared, np.uint16).tobytes())
+        f.write(np.array(suffix, np.uint16).tobytes())
+        f.write(keys)
+    replace(f"{path}.tmp", path)
+
+
+def load_ltm(path, columnar=False):
+    # Decode every chunk and put them back in their original order
+    ltm_file = open_ltm(path)
+    text = ltm_file.keys_bytes().decode()
+    chunks, previous, start = [], "", 0
+    for n_shared, n_suffix in zip(ltm_file.shared.tolist(), ltm_file.suffix.tolist()):
+        previous = previous[:n_shared] + text[start : start + n_suffix]
+        start += n_suffix
+        chunks.append(previous)
+    original = np.argsort(ltm_file.order)
+    chunks = [chunks[i] for i in original.tolist()]
+    pt = ltm_file.pt[original]
+    if not columnar:
+        return dict(zip(chunks, pt.tolist()))
+    ltm = LTM()
+    ltm.slots = dict(zip(chunks, range(len(chunks))))
+    ltm.pt = array("d", pt.tobytes())
+    return ltm
+
+
+def open_ltm(path):
+    return LTMFile(path)
+
+
+class LTMFile(Mapping):
+    # Read-only LTM mapped from a file written by save_ltm. Looking up a chunk only
+    # decodes the restart blocks on its binary search path. Iterates in sorted order.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+        header = self.buffer[: LTM_HEADER.size]
+        if not header.startswith(LTM_MAGIC) or len(header) < LTM_HEADER.size:
+            raise ValueError(f"Not an LTM file: {path}")
+        magic, version, n_chunks, restart, n_bytes = LTM_HEADER.unpack(header)
+        if version != LTM_VERSION:
+            raise ValueError(f"Unsupported LTM file version: {version}")
+        n_blocks = -(-n_chunks // restart)
+        start = LTM_HEADER.size
+        self.restart = restart
+        self.pt = np.frombuffer(self.buffer, np.float64, n_chunks, start)
+        start += 8 * n_chunks
+        self.blocks = np.frombuffer(self.buffer, np.uint64, n_blocks + 1, start)
+        start += 8 * (n_blocks + 1)
+        self.order = np.frombuffer(self.buffer, np.uint32, n_chunks, start)
+        start += 4 * n_chunks
+        self.shared = np.frombuffer(self.buffer, np.uint16, n_chunks, start)
+        start += 2 * n_chunks
+        self.suffix = np.frombuffer(self.buffer, np.uint16, n_chunks, start)
+        self.keys_start = start + 2 * n_chunks
+
+    def __len__(self):
+        return len(self.pt)
+
+    def __iter__(self):
+        for i in range(len(self.blocks) - 1):
+            yield from self.block(i)
+
+    def __contains__(self, chunk):
+        return self.find(chunk) >= 0
+
+    def __getitem__(self, chunk):
+        i = self.find(chunk)
+        if i < 0:
+            raise KeyError(chunk)
+        return float(self.pt[i])
+
+    def keys_bytes(self, start=0, end=None):
+        end = int(self.blocks[-1]) if end is None else end
+        return self.buffer[self.keys_start + start : self.keys_start + end]
+
+    def block(self, block):
+        # Decode the chunks in a restart block
+        start, end = self.blocks[block : block + 2].tolist()
+        text = self.keys_bytes(start, end).decode()
+        first = block * self.restart
+        shared = self.shared[first : first + self.restart].tolist()
+        suffix = self.suffix[first : first + self.restart].tolist()
+        chunks, previous, start = [], "", 0
+        for n_shared, n_suffix in zip(shared, suffix):
+            previous = previous[:n_shared] + text[start : start + n_suffix]
+            start += n_suffix
+            chunks.append(previous)
+        return chunks
 
+    def first(self, block):
+        # The first chunk of a block is stored whole, so only it needs decoding
+        start, end = self.blocks[block : block + 2].tolist()
+        n_suffix = int(self.suffix[block * self.restart])
+        text = self.keys_bytes(start, min(end, start + 4 * n_suffix))
+        return text.decode(errors="ignore")[:n_suffix]
 
-def ltm_to_df(ltm):
-    return pd.DataFrame(list(ltm.items()), columns=["chunks", "pt"])
+    def find(self, chunk):
+        # Sorted position of the chunk (or -1), from the last block starting at or
+        # before it
+        low, high = 0, len(self.blocks) - 1
+        while low < high:
+            mid = (low + high) // 2
+            if self.first(mid) <= chunk:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return -1
+        chunks = self.block(low - 1)
+        i = bisect_left(chunks, chunk)
+        if i < len(chunks) and chunks[i] == chunk:
+            return (low - 1) * self.restart + i
+        return -1